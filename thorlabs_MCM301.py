@@ -1,6 +1,19 @@
 # Imports from the python standard library:
+import abc
+import bisect
+import collections
 import ctypes as C
+import itertools
+import json
+import logging
+import math
 import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from functools import partial
 
 class Controller:
     '''
@@ -16,32 +29,118 @@ class Controller:
                  velocity=3*(100,), # 3-tuple velocity % e.g. (10, 50, 100)
                  home_to_min=3*(True,), # 3-tuple e.g. (False, True, True)
                  name='MCM301',
+                 backend=None, # 'Backend' e.g. SimulatedMCM301 (default: .dll)
+                 dll_path=None, # explicit .dll path (default: search)
+                 devices=None, # from 'list_devices' (skips enumerating)
+                 wait_strategy='model', # 'busy', 'fixed' or 'model'
+                 poll_interval_s=0.01, # status poll period for 'fixed'
+                 metrics=False, # time every .dll call (see 'metrics')
+                 session_cache=None, # .json file for fast warm attach
+                 home_timeout_s=60, # per channel, None waits forever
+                 home_in_background=False, # see 'home_all(block=False)'
+                 thread_safe=False, # queue the .dll calls, 'stop' first
+                 coalesce_s=None, # min s between non-blocking moves per ch
+                 watchdog=True, # stop stalled/late moves (MoveTimeoutError)
                  verbose=True,
                  very_verbose=False):
         self.name = name
         self.verbose = verbose
         self.very_verbose = very_verbose
+        # 'thorlabs_MCM301.<name>' with a child per channel ('.ch0' etc.):
+        self.logger = logging.getLogger('thorlabs_MCM301.%s'%name)
+        self._loggers = {ch: self.logger.getChild('ch%i'%ch)
+                         for ch in range(3)}
+        if very_verbose: # otherwise leave the level to the application
+            self.logger.setLevel(logging.DEBUG)
+        elif verbose:
+            self.logger.setLevel(logging.INFO)
+        if (verbose or very_verbose) and not self.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.propagate = False # (not twice via the root logger)
+        assert wait_strategy in ('busy', 'fixed', 'model')
+        assert poll_interval_s > 0
+        assert coalesce_s is None or coalesce_s > 0
+        self.wait_strategy = wait_strategy
+        self.poll_interval_s = poll_interval_s
+        self.coalesce_s = coalesce_s
+        self.watchdog = watchdog # see '_check_watchdog' for the settings:
+        self.watchdog_scale = 2 # deadline = scale * predicted + margin_s
+        self.watchdog_margin_s = 1
+        self.stall_s = 0.5 # encoder unchanged for this long -> stalled
+        self.stall_counts = 100 # ...unless this close to the target
+        self.watchdog_faults = [] # dicts with the time to detect each fault
+        if backend is None: # .dll is loaded on first use, not at import
+            backend = load_dll(dll_path)
+        self._backend = backend
+        self._call_histograms = None # see 'enable_metrics'
+        self._tracer = None # see 'start_trace'
+        self._last_tracer = None # kept for 'dump_trace' after 'stop_trace'
+        if thread_safe: # one worker thread per handle runs the calls
+            self.dll = _QueuedBackend(backend, _CommandQueue(name))
+        else: # one caller at a time
+            self.dll = _LockedBackend(backend)
+        if metrics:
+            self.enable_metrics()
+        self._snapshot = {} # latest status per channel (see 'get_state')
+        self._snapshot_lock = threading.Lock()
+        self._poller = None
+        self._streams = [] # running 'StatusStream's (see 'start_stream')
+        self._pending_mm = {} # latest unsent target per ch (see '_coalesce')
+        self._pending_from_mm = {} # last target sent before it
+        self._coalesce_lock = threading.Lock()
+        self._flush_lock = threading.Lock() # held while sending a pending one
+        self._coalesce_event = threading.Event()
+        self._coalescer = None # thread sending the pending targets
+        self._pending_handles = {} # 'MoveHandle's of the pending targets
+        self._handles = {} # ch -> 'MoveHandle's completed when it stops
+        self._handles_cond = threading.Condition()
+        self._handle_waiter = None # thread polling for the handles
+        # Look for a previous session with the same controller and stages
+        # (skips the checks and readbacks done by a cold start):
+        self._session_cache = session_cache
+        self._session_key = '%s %s'%(sn, tuple(stages))
+        session = None
+        if session_cache is not None:
+            session = _load_session(session_cache).get(self._session_key)
+            if session is not None and any(
+                cached is not None and cached != home_to_min[ch]
+                for ch, cached in enumerate(session['home_to_min'])):
+                session = None # home direction changed -> cold start
+            self._session = session
+            self.logger.info(
+                '%s: session cache -> %s start', self.name,
+                'cold' if session is None else 'warm')
         # Find MCM301 controller:
-        if self.verbose: print("%s: opening..."%self.name)
-        devices = self._list_devices()
-        assert sn in devices, (
-            "%s: device (sn=%s) not found"%(self.name, sn))
+        self.logger.info('%s: opening...', self.name)
+        if session is None:
+            if devices is None: devices = self._list_devices()
+            assert sn in devices, (
+                "%s: device (sn=%s) not found"%(self.name, sn))
         self.hdl = self._open(sn, nBaud=115200, timeout=1)
-        assert self._is_open(sn)
-        if self.verbose: print("%s: -> open and ready."%self.name)
+        if session is None:
+            assert self._is_open(sn)
+        self.logger.info('%s: -> open and ready.', self.name)
         # Find attached stages and assign channels:
         attached_stages, channels = [], []
         self.ch_to_slot = {0:4, 1:5, 2:6} # map channels to available 'slots'
-        for ch in range(3):
+        for ch in range(3): # (also checks the stages of a warm start)
             stage = self._get_device_type(self.ch_to_slot[ch])
             attached_stages.append(stage)
             if stage is not None:
                 channels.append(ch)
         self.attached_stages = tuple(attached_stages)
         self.channels = tuple(channels)
-        if self.verbose:
-            print("%s: attached stages = %s"%(self.name, self.attached_stages))
-            print("%s: available channels = %s"%(self.name, self.channels))
+        if session is not None and stages != self.attached_stages:
+            self.logger.warning(
+                '%s: attached stages changed -> session cache not used',
+                self.name)
+            session = self._session = None
+        self.logger.info(
+            '%s: attached stages = %s', self.name, self.attached_stages)
+        self.logger.info(
+            '%s: available channels = %s', self.name, self.channels)
         assert stages == self.attached_stages, (
             "%s: initialized stages (%s) do not match attached stages (%s)"%(
                 self.name, stages, self.attached_stages))
@@ -59,7 +158,10 @@ class Controller:
             self.min_mm[ch], self.max_mm[ch] = min_mm[ch], max_mm[ch]
             if not home_to_min[ch]: # range goes negative
                 self.min_mm[ch], self.max_mm[ch] = -max_mm[ch], -min_mm[ch]
-            self._set_home_to_min(ch, home_to_min[ch])
+            if session is None:
+                self._set_home_to_min(ch, home_to_min[ch])
+            else: # set last session, re-set below if the stage needs homing
+                self._home_to_min[ch] = home_to_min[ch]
         # Get stage parameters:
         self._counts_per_step   = len(self.channels)*[None]
         self._nm_per_count      = len(self.channels)*[None]
@@ -67,123 +169,328 @@ class Controller:
         self._max_count         = len(self.channels)*[None]
         self._max_speed         = len(self.channels)*[None]
         self._max_acceleration  = len(self.channels)*[None]
+        self._local_rounding    = len(self.channels)*[None]
         for ch in self.channels:
-            self._get_stage_parameters(ch)
+            if session is None:
+                self._get_stage_parameters(ch)
+                self._check_local_conversion(ch)
+            else:
+                self._set_session_parameters(ch, session['channels'][ch])
         # Get status and enable:
         self._enabled       = len(self.channels)*[None]
         self._homed         = len(self.channels)*[None]
         self._moving        = len(self.channels)*[None]
         self._encoder_count = len(self.channels)*[None]
-        self.position_mm    = len(self.channels)*[None]
-        for ch in self.channels:
-            self._get_status(ch)
+        self.position_mm    = len(self.channels)*[None] # last verified
+        self._target_mm     = len(self.channels)*[None] # last commanded
+        self._waiting       = len(self.channels)*[0] # wait loops per ch
+        self._target_count  = len(self.channels)*[None] # for the watchdog
+        self._deadline      = len(self.channels)*[None]
+        self._encoder_changed_t = len(self.channels)*[None]
+        self._status_t      = len(self.channels)*[None] # last status read
+        self._move_t0       = len(self.channels)*[None] # last move issued
+        self._move_time_s   = len(self.channels)*[None] # predicted duration
+        self._motion_calibration = len(self.channels)*[(1, 0)] # scale, s
+        self._motion_calibrated = len(self.channels)*[False] # (deadlines)
+        self.wait_stats     = len(self.channels)*[None] # last wait per ch
+        self.coalesced      = len(self.channels)*[0] # superseded targets
+        self._jog_step_counts = len(self.channels)*[None] # see 'jog'
+        self._jog_count     = len(self.channels)*[None] # counted position
+        self._jog_steps     = len(self.channels)*[0] # since reconciling
+        self.jog_reconcile_steps = 100 # steps between encoder checks
+        self.jog_stats      = len(self.channels)*[None] # last jog per ch
+        for ch in self.channels: # (one status sweep for a warm start)
+            status_bit = self._get_status(ch)
+            if session is not None:
+                assert status_bit & 0x00000100, (
+                    "%s(ch%s): stage not connected (stale session cache?)"%(
+                        self.name, ch))
+                if session['channels'][ch]['motion_calibration'] is not None:
+                    self._motion_calibration[ch] = tuple(
+                        session['channels'][ch]['motion_calibration'])
+                    self._motion_calibrated[ch] = True
+                if not self._homed[ch]: # e.g. power cycled -> set again
+                    self._set_home_to_min(ch, home_to_min[ch])
             if not self._enabled[ch]:
                 self._set_enable(ch, True)
         # Home if needed, set velocity and get position:
+        self.homing_errors = {}
+        self.homed_events = {} # one per channel, set when homed
         for ch in self.channels:
-            if not self._homed[ch]:
-                self._home(ch, block=False) # send home commands back to back
+            self.homed_events[ch] = threading.Event()
+            self.homed_events[ch].set()
+        try:
+            self.home_all( # (replaces the events of the channels it homes)
+                [ch for ch in self.channels if not self._homed[ch]],
+                timeout=home_timeout_s, block=not home_in_background)
+            for ch in self.channels:
+                self.set_velocity(ch, velocity[ch])
+                self.get_position_mm(ch)
+                if self._target_mm[ch] is None: # (homing sets 0)
+                    self._target_mm[ch] = self.position_mm[ch]
+        except BaseException: # e.g. homing timed out -> release the device
+            self._stop_threads()
+            self._close_handle()
+            raise
+        if session_cache is not None:
+            self._save_session()
+
+    def _set_session_parameters(self, ch, cached):
+        # stage parameters and conversion from the session cache:
+        parameters = cached['stage_parameters']
+        self._counts_per_step[ch]  = parameters['counts_per_step']
+        self._nm_per_count[ch]     = parameters['nm_per_count']
+        self._min_count[ch]        = parameters['min_count']
+        self._max_count[ch]        = parameters['max_count']
+        self._max_speed[ch]        = parameters['max_speed']
+        self._max_acceleration[ch] = parameters['max_acceleration']
+        self._local_rounding[ch]   = cached['local_rounding']
+        self._loggers[ch].debug(
+            '%s(ch%s): stage parameters (cached) = %s',
+            self.name, ch, parameters)
+        return None
+
+    def _save_session(self):
+        # store what a warm start needs under the serial number and stages:
+        channels = 3*[None]
         for ch in self.channels:
-            if not self._homed[ch]:
-                self._finish_moving(ch)
-            self.set_velocity(ch, velocity[ch])
-            self.get_position_mm(ch)
+            channels[ch] = {
+                'stage_parameters': {
+                    'counts_per_step':  self._counts_per_step[ch],
+                    'nm_per_count':     self._nm_per_count[ch],
+                    'min_count':        self._min_count[ch],
+                    'max_count':        self._max_count[ch],
+                    'max_speed':        self._max_speed[ch],
+                    'max_acceleration': self._max_acceleration[ch]},
+                'local_rounding': self._local_rounding[ch],
+                'motion_calibration': list(self._motion_calibration[ch])}
+        home_to_min = [None if ch not in self.channels else
+                       self._home_to_min[ch] for ch in range(3)]
+        session = {'home_to_min': home_to_min, 'channels': channels}
+        if session == self._session: # unchanged, skip the slow file write
+            return None
+        import tempfile # only needed here, keeps the import fast
+        with _session_lock: # (controllers sharing the file, e.g. a pool)
+            sessions = _load_session(self._session_cache)
+            sessions[self._session_key] = self._session = session
+            with tempfile.NamedTemporaryFile( # unique, replace atomically
+                'w', dir=os.path.dirname(os.path.abspath(self._session_cache)),
+                suffix='.tmp', delete=False) as file:
+                json.dump(sessions, file, indent=1)
+            os.replace(file.name, self._session_cache)
+        self.logger.debug(
+            '%s: saved session to %s', self.name, self._session_cache)
+        return None
 
     def _list_devices(self):
-        if self.very_verbose:
-            print("%s: listing devices"%self.name)
-        buffer = (10240 * C.c_char)()
-        dll.list_devices(buffer, len(buffer))
-        devices = buffer.value.decode('ascii').split(',')
-        if self.very_verbose:
-            print("%s: devices = %s"%(self.name, devices))
+        self.logger.debug('%s: listing devices', self.name)
+        devices = list_devices(self.dll)
+        self.logger.debug('%s: devices = %s', self.name, devices)
         return devices
 
     def _open(self, sn, nBaud, timeout):
-        if self.very_verbose:
-            print("%s: opening device (sn=%s, nBaud=%i, timeout=%i)"%(
-                self.name, sn, nBaud, timeout))
-        hdl = dll.open(sn.encode('ascii'), nBaud, timeout)
+        self.logger.debug(
+            '%s: opening device (sn=%s, nBaud=%i, timeout=%i)',
+            self.name, sn, nBaud, timeout)
+        hdl = self.dll.open(sn.encode('ascii'), nBaud, timeout)
         if hdl < 0:
             raise Exception("%s: device (sn=%s) not found"%(self.name, sn))
-        if self.very_verbose:
-            print("%s: -> device open (hdl=%s)"%(self.name, hdl))
+        self.logger.debug('%s: -> device open (hdl=%s)', self.name, hdl)
         return hdl
 
     def _is_open(self, sn):
-        if self.very_verbose:
-            print("%s: checking device is open (sn=%s)"%(self.name, sn))
-        assert dll.is_open(sn.encode('ascii')) == 1, (
+        self.logger.debug(
+            '%s: checking device is open (sn=%s)', self.name, sn)
+        assert self.dll.is_open(sn.encode('ascii')) == 1, (
             "%s: device (sn=%s) is not open"%(self.name, sn))
-        if self.very_verbose:
-            print("%s: -> device is open"%self.name)
+        self.logger.debug('%s: -> device is open', self.name)
         return True
 
     def _get_device_type(self, slot):
-        if self.very_verbose:
-            print("%s: getting device type (slot=%s)"%(self.name, slot))
+        self.logger.debug(
+            '%s: getting device type (slot=%s)', self.name, slot)
         buffer = (16 * C.c_char)()
-        dll.get_device_type(self.hdl, slot, buffer, len(buffer))
+        self.dll.get_device_type(self.hdl, slot, buffer, len(buffer))
         device_type = buffer.value.decode('ascii')
         if len(device_type) == 0: device_type = None
-        if self.very_verbose:
-            print("%s: = %s"%(self.name, device_type))
+        self.logger.debug('%s: = %s', self.name, device_type)
         return device_type
 
     def _get_stage_parameters(self, ch):
-        if self.very_verbose:
-            print("%s(ch%s): getting stage parameters"%(self.name, ch))
+        self._loggers[ch].debug(
+            '%s(ch%s): getting stage parameters', self.name, ch)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
         parameters = StageParamStruct()
-        dll.get_stage_parameters(self.hdl, self.ch_to_slot[ch], parameters)
+        self.dll.get_stage_parameters(
+            self.hdl, self.ch_to_slot[ch], parameters)
         self._counts_per_step[ch]  = parameters.counts_per_step
         self._nm_per_count[ch]     = parameters.nm_per_count
         self._min_count[ch]        = parameters.min_count
         self._max_count[ch]        = parameters.max_count
         self._max_speed[ch]        = parameters.max_speed
         self._max_acceleration[ch] = parameters.max_acceleration
-        if self.very_verbose:
-            print("%s(ch%s): counts_per_step  = %s "%(
-                self.name, ch, self._counts_per_step[ch]))
-            print("%s(ch%s): nm_per_count     = %s "%(
-                self.name, ch, self._nm_per_count[ch]))
-            print("%s(ch%s): min_count        = %s "%(
-                self.name, ch, self._min_count[ch]))
-            print("%s(ch%s): max_count        = %s "%(
-                self.name, ch, self._max_count[ch]))
-            print("%s(ch%s): max_speed        = %s "%(
-                self.name, ch, self._max_speed[ch]))
-            print("%s(ch%s): max_acceleration = %s "%(
-                self.name, ch, self._max_acceleration[ch]))
+        if self._loggers[ch].isEnabledFor(logging.DEBUG):
+            self._loggers[ch].debug(
+                '%s(ch%s): counts_per_step  = %s ',
+                self.name, ch, self._counts_per_step[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): nm_per_count     = %s ',
+                self.name, ch, self._nm_per_count[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): min_count        = %s ',
+                self.name, ch, self._min_count[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): max_count        = %s ',
+                self.name, ch, self._max_count[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): max_speed        = %s ',
+                self.name, ch, self._max_speed[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): max_acceleration = %s ',
+                self.name, ch, self._max_acceleration[ch])
         return parameters
 
+    def _check_local_conversion(self, ch):
+        # The nm <-> encoder conversions are arithmetic on 'nm_per_count' so
+        # compare a few values with the .dll once and then convert locally
+        # (with the rounding the .dll uses). Falls back to the .dll if no
+        # rounding mode matches:
+        nm_per_count = self._nm_per_count[ch]
+        counts = (0, 1, -1, 12345, -12345, self._min_count[ch],
+                  self._max_count[ch], -self._max_count[ch])
+        fractions = (0.25, 0.75, -0.25, -0.75, 1000.3, -1000.7)
+        self._local_rounding[ch] = None
+        nm = C.c_double()
+        for encoder_count in counts:
+            self.dll.get_position(
+                self.hdl, self.ch_to_slot[ch], encoder_count, nm)
+            if abs(nm.value - encoder_count * nm_per_count) > 1e-6:
+                self._loggers[ch].warning(
+                    '%s(ch%s): ***WARNING*** local conversion does not '
+                    'match .dll (using .dll)', self.name, ch)
+                return None
+        dll_counts = [self._get_encoder_count(ch, 1e-6 * f * nm_per_count)
+                      for f in fractions]
+        for rounding, function in _ROUNDING.items():
+            if dll_counts == [function(f) for f in fractions]:
+                self._local_rounding[ch] = rounding
+                break
+        else:
+            self._loggers[ch].warning(
+                '%s(ch%s): ***WARNING*** local conversion does not '
+                'match .dll (using .dll)', self.name, ch)
+        self._loggers[ch].debug(
+            '%s(ch%s): local conversion rounding = %s',
+            self.name, ch, self._local_rounding[ch])
+        return None
+
+    def mm_to_counts(self, ch, position_mm):
+        '''
+        Encoder counts for a position or array of positions (mm) e.g. for
+        planning a whole trajectory without a .dll call per point. Returns a
+        numpy int array (or a scalar for a scalar input).
+        '''
+        import numpy as np # only needed here, keeps the import fast
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        nm = 1e6 * np.asarray(position_mm, dtype='float64')
+        rounding = self._local_rounding[ch]
+        if rounding is None: # .dll round trip per value
+            counts = np.vectorize(
+                lambda x: self._get_encoder_count(ch, x), otypes=['int64'])(
+                    1e-6 * nm)
+        else:
+            counts = nm / self._nm_per_count[ch]
+            if rounding == 'nearest':
+                counts = np.floor(counts + 0.5)
+            elif rounding == 'truncate':
+                counts = np.trunc(counts)
+            else:
+                counts = np.floor(counts)
+            counts = counts.astype('int64')
+        return counts if counts.ndim else counts.item()
+
+    def counts_to_mm(self, ch, encoder_counts):
+        '''
+        Position (mm, not rounded) for an encoder count or array of counts.
+        Returns a numpy float array (or a scalar for a scalar input).
+        '''
+        import numpy as np # only needed here, keeps the import fast
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        counts = np.asarray(encoder_counts, dtype='int64')
+        if self._local_rounding[ch] is None: # .dll round trip per value
+            mm = np.vectorize(
+                lambda x: self._get_nm(ch, int(x)), otypes=['float64'])(
+                    counts) * 1e-6
+        else:
+            mm = 1e-6 * self._nm_per_count[ch] * counts
+        return mm if mm.ndim else mm.item()
+
+    def _get_nm(self, ch, encoder_count):
+        if self._local_rounding[ch] is not None:
+            return encoder_count * self._nm_per_count[ch]
+        nm = C.c_double()
+        self.dll.get_position(self.hdl, self.ch_to_slot[ch], encoder_count, nm)
+        return nm.value
+
     def _get_home_to_min(self, ch):
-        if self.very_verbose:
-            print("%s(ch%s): getting home to min"%(self.name, ch))
+        self._loggers[ch].debug(
+            '%s(ch%s): getting home to min', self.name, ch)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
         home_to_min = (1 * C.c_char)()
-        dll.get_home_to_min(self.hdl, self.ch_to_slot[ch], home_to_min)
+        self.dll.get_home_to_min(self.hdl, self.ch_to_slot[ch], home_to_min)
         self._home_to_min[ch] = bool(home_to_min.value)
-        if self.very_verbose:
-            print("%s(ch%s): = %s"%(self.name, ch, self._home_to_min[ch]))
+        self._loggers[ch].debug(
+            '%s(ch%s): = %s', self.name, ch, self._home_to_min[ch])
         return self._home_to_min[ch]
 
     def _set_home_to_min(self, ch, home_to_min):
-        if self.very_verbose:
-            print("%s(ch%s): setting home to min = %s"%(
-                self.name, ch, home_to_min))
+        self._loggers[ch].debug(
+            '%s(ch%s): setting home to min = %s', self.name, ch, home_to_min)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
         assert isinstance(home_to_min, bool)
-        dll.set_home_to_min(self.hdl, self.ch_to_slot[ch], home_to_min)
+        self.dll.set_home_to_min(self.hdl, self.ch_to_slot[ch], home_to_min)
         assert self._get_home_to_min(ch) == home_to_min
-        if self.very_verbose:
-            print("%s(ch%s): -> done setting home to min"%(self.name, ch))
+        self._loggers[ch].debug(
+            '%s(ch%s): -> done setting home to min', self.name, ch)
         return None
 
-    def _get_status(self, ch):
+    def _read_status(self, ch):
+        # one 'GetMotStatus' round trip, stored as the channel snapshot:
+        t = time.perf_counter()
+        encoder_count, status_bit = C.c_int(), C.c_uint()
+        self.dll.get_status(
+            self.hdl, self.ch_to_slot[ch], encoder_count, status_bit)
+        enabled, homed, moving = _decode_status(status_bit.value)
+        snapshot = {'t': t,
+                    'encoder_count': encoder_count.value,
+                    'status_bit': status_bit.value,
+                    'enabled': enabled,
+                    'homed': homed,
+                    'moving': moving}
+        with self._snapshot_lock:
+            if ch not in self._snapshot or self._snapshot[ch]['t'] < t:
+                self._snapshot[ch] = snapshot
+        return snapshot
+
+    def _get_snapshot(self, ch, max_age):
+        # cached status if younger than 'max_age' (s) and read after the
+        # last command was issued, otherwise None:
+        with self._snapshot_lock:
+            snapshot = self._snapshot.get(ch)
+        if snapshot is None:
+            return None
+        if time.perf_counter() - snapshot['t'] > max_age:
+            return None
+        if self._move_t0[ch] is not None and snapshot['t'] < self._move_t0[ch]:
+            return None
+        return snapshot
+
+    def _get_status(self, ch, max_age=None):
         """
         0x00000001:'On positive direction hardware limit switch'
         0x00000002:'On negative direction hardware limit switch'
@@ -198,173 +505,1721 @@ class Controller:
         0x00000400:'Homed'
         0x80000000:'Channel enabled'
         """
-        if self.very_verbose:
-            print("%s(ch%s): getting status"%(self.name, ch))
+        self._loggers[ch].debug('%s(ch%s): getting status', self.name, ch)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
-        encoder_count, status_bit = C.c_int(), C.c_uint()
-        dll.get_status(
-            self.hdl, self.ch_to_slot[ch], encoder_count, status_bit)
-        self._encoder_count[ch] = encoder_count.value
-        status_bit = status_bit.value
-        # check if enabled, homed or moving:
-        self._enabled[ch] = False
-        if status_bit & 0x80000000 == 0x80000000:
-            self._enabled[ch] = True
-        self._homed[ch] = False
-        if status_bit & 0x00000400 == 0x00000400:
-            self._homed[ch] = True
-        moving_masks = (
-            0x00000010, 0x00000020, 0x00000040, 0x00000080, 0x00000200)
-        self._moving[ch] = False
-        for mask in moving_masks:
-            if status_bit & mask == mask:
-                self._moving[ch] = True
-        if self.very_verbose:
-            print("%s(ch%s): status_bit = %s (encoder_count=%i)"%(
-                self.name, ch, hex(status_bit), self._encoder_count[ch]))
-            print("%s(ch%s): enabled = %s"%(self.name, ch, self._enabled[ch]))
-            print("%s(ch%s): homed   = %s"%(self.name, ch, self._homed[ch]))
-            print("%s(ch%s): moving  = %s"%(self.name, ch, self._moving[ch]))
+        snapshot = None
+        if max_age is not None: # accept a cached status if fresh enough
+            snapshot = self._get_snapshot(ch, max_age)
+        while snapshot is None or (self._move_t0[ch] is not None and
+                                   snapshot['t'] < self._move_t0[ch]):
+            snapshot = self._read_status(ch) # (again if a move overtook it)
+        was_moving = self._moving[ch]
+        if snapshot['encoder_count'] != self._encoder_count[ch]:
+            self._encoder_changed_t[ch] = snapshot['t']
+        self._status_t[ch] = snapshot['t'] # (cached by a slow poller?)
+        self._encoder_count[ch] = snapshot['encoder_count']
+        status_bit = snapshot['status_bit']
+        self._enabled[ch] = snapshot['enabled']
+        self._homed[ch]   = snapshot['homed']
+        self._moving[ch]  = snapshot['moving']
+        if was_moving and not self._moving[ch]:
+            self._settled(ch, snapshot['t'])
+        if self._loggers[ch].isEnabledFor(logging.DEBUG):
+            self._loggers[ch].debug(
+                '%s(ch%s): status_bit = %s (encoder_count=%i)',
+                self.name, ch, hex(status_bit), self._encoder_count[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): enabled = %s', self.name, ch, self._enabled[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): homed   = %s', self.name, ch, self._homed[ch])
+            self._loggers[ch].debug(
+                '%s(ch%s): moving  = %s', self.name, ch, self._moving[ch])
         return status_bit
 
+    def _settled(self, ch, t_settled):
+        # a move (or homing) just finished: store the encoder verified
+        # position and complete the 'MoveHandle's of the channel:
+        nm = self._get_nm(ch, self._encoder_count[ch])
+        self.position_mm[ch] = round(1e-6 * nm, 3)
+        if self._target_mm[ch] is None: # stopped -> wherever it is
+            self._target_mm[ch] = self.position_mm[ch]
+        if self._tracer is not None:
+            self._tracer.end_move(ch, t_settled)
+        with self._handles_cond:
+            handles = self._handles.pop(ch, ())
+        for handle in handles:
+            handle._settled(self.position_mm[ch], t_settled)
+        return None
+
+    def _watch(self, ch, target_count, deadline=True):
+        # arm the watchdog for a command just issued (see '_check_watchdog'):
+        self._target_count[ch] = target_count
+        self._encoder_changed_t[ch] = self._move_t0[ch]
+        self._deadline[ch] = None
+        if deadline and (self._move_time_s[ch] == 0 or # (stop: margin only)
+                         self._motion_calibrated[ch]): # units are assumed
+            self._deadline[ch] = (
+                self._move_t0[ch] + self.watchdog_margin_s +
+                self.watchdog_scale * self._move_time_s[ch])
+        return None
+
+    def _check_watchdog(self, ch):
+        # For a channel that still reports moving: stop it and raise
+        # MoveTimeoutError if it is past its deadline (the motion model
+        # prediction times 'watchdog_scale' plus 'watchdog_margin_s', only
+        # once 'calibrate_motion_model' has checked the model) or stalled
+        # (encoder unchanged for 'stall_s' while further than
+        # 'stall_counts' from the target, not while homing, timed by the
+        # status reads so an old cached status can't look like a stall):
+        if not self.watchdog:
+            return None
+        t = time.perf_counter()
+        deadline, target_count = self._deadline[ch], self._target_count[ch]
+        if deadline is not None and t > deadline:
+            reason = 'deadline' # detected this long after expected arrival:
+            detect_s = t - self._move_t0[ch] - self._move_time_s[ch]
+        elif (target_count is not None and
+              self._status_t[ch] - self._encoder_changed_t[ch] > self.stall_s
+              and abs(self._encoder_count[ch] - target_count) >
+              self.stall_counts):
+            reason = 'stall' # detected this long after it stopped changing:
+            detect_s = t - self._encoder_changed_t[ch]
+        else:
+            return None
+        error = MoveTimeoutError(
+            self.name, ch, reason, self._encoder_count[ch], target_count,
+            t - self._move_t0[ch], detect_s)
+        self._stop(ch)
+        self.watchdog_faults.append({'ch': ch,
+                                     'reason': reason,
+                                     'encoder_count': error.encoder_count,
+                                     'target_count': target_count,
+                                     'elapsed_s': error.elapsed_s,
+                                     'detect_s': detect_s})
+        self._loggers[ch].error('%s', error)
+        raise error
+
+    def _poll_moving(self, ch, max_age=None):
+        # one status poll in a wait loop (raises MoveTimeoutError):
+        self._get_status(ch, max_age)
+        if self._moving[ch]:
+            self._check_watchdog(ch)
+        return None
+
+    def _get_target_mm(self, ch):
+        # where the channel is going (the base for relative moves):
+        if self._target_mm[ch] is None: # stopping -> wait until it stops
+            self._finish_moving(ch)
+        if self._target_mm[ch] is None: # stopped while idle -> where it is
+            self._target_mm[ch] = self.get_position_mm(ch)
+        return self._target_mm[ch]
+
     def _get_enable(self, ch):
-        if self.very_verbose:
-            print("%s(ch%s): getting enable"%(self.name, ch))
+        self._loggers[ch].debug('%s(ch%s): getting enable', self.name, ch)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
         enable = (1 * C.c_char)()
-        dll.get_enable(self.hdl, self.ch_to_slot[ch], enable)
+        self.dll.get_enable(self.hdl, self.ch_to_slot[ch], enable)
         self._enabled[ch] = bool(enable.value)
-        if self.very_verbose:
-            print("%s(ch%s): = %s"%(self.name, ch, self._enabled[ch]))
+        self._loggers[ch].debug(
+            '%s(ch%s): = %s', self.name, ch, self._enabled[ch])
         return self._enabled[ch]
 
     def _set_enable(self, ch, enable):
-        if self.very_verbose:
-            print("%s(ch%s): setting enable = %s"%(self.name, ch, enable))
+        self._loggers[ch].debug(
+            '%s(ch%s): setting enable = %s', self.name, ch, enable)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
         assert isinstance(enable, bool)
-        dll.set_enable(self.hdl, self.ch_to_slot[ch], enable)
+        self.dll.set_enable(self.hdl, self.ch_to_slot[ch], enable)
         assert self._get_enable(ch) == enable
-        if self.very_verbose:
-            print("%s(ch%s): -> done setting enable"%(self.name, ch))
+        self._loggers[ch].debug(
+            '%s(ch%s): -> done setting enable', self.name, ch)
+        return None
+
+    def _predict_move(self, ch, distance_mm):
+        # record when the move started and how long it should take:
+        self._move_t0[ch] = time.perf_counter()
+        self._move_time_s[ch] = self.estimate_move_time(ch, 0, distance_mm)
         return None
 
-    def _finish_moving(self, ch):
-        while self._moving[ch]:
-            self._get_status(ch)
-        if self.verbose:
-            print('%s(ch%s): -> finished moving'%(self.name, ch))
+    def estimate_move_time(self, ch, from_mm, to_mm):
+        '''
+        Predicted time (s) to move between two positions from the stage
+        motion model: a trapezoidal velocity profile limited by
+        'max_speed' (assumed mm/s) and 'max_acceleration' (assumed mm/s^2),
+        scaled and offset by 'calibrate_motion_model' if it has been run.
+        See 'thorlabs_MCM301_scan.plan_scan' for whole trajectories.
+        '''
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        distance_mm = abs(to_mm - from_mm)
+        if distance_mm == 0:
+            return 0
+        scale, offset_s = self._motion_calibration[ch]
+        return offset_s + scale * _move_time_s(
+            distance_mm, self._max_speed[ch], self._max_acceleration[ch])
+
+    def calibrate_motion_model(self, ch, distances_mm=(0.01, 0.1, 1, 3)):
+        '''
+        Time real moves of each distance (out and back from the current
+        position) and fit measured = scale * model + offset_s by least
+        squares, so 'estimate_move_time' matches this stage and link.
+        Returns a dict with 'scale', 'offset_s' and the 'rms_error_s'.
+        '''
+        self._loggers[ch].info(
+            '%s(ch%s): calibrating motion model', self.name, ch)
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        self._motion_calibration[ch] = (1, 0)
+        self._motion_calibrated[ch] = False
+        start_mm = self._get_target_mm(ch)
+        model_s, measured_s = [], []
+        for distance_mm in distances_mm:
+            if start_mm + distance_mm > self.max_mm[ch]:
+                distance_mm = -distance_mm # go the other way
+            for position_mm in (start_mm + distance_mm, start_mm):
+                assert self.min_mm[ch] <= position_mm <= self.max_mm[ch], (
+                    "%s(ch%s): calibration move out of limits"%(self.name, ch))
+                t0 = time.perf_counter()
+                self.move_mm(ch, position_mm, relative=False, block=False)
+                self.finish_moving_many((ch,), strategy='busy')
+                measured_s.append(time.perf_counter() - t0)
+                model_s.append(self.estimate_move_time(ch, 0, distance_mm))
+        n = len(model_s)
+        mean_model, mean_measured = sum(model_s) / n, sum(measured_s) / n
+        variance = sum((m - mean_model)**2 for m in model_s)
+        scale = 1
+        if variance > 0:
+            scale = sum((m - mean_model) * (t - mean_measured)
+                        for m, t in zip(model_s, measured_s)) / variance
+        offset_s = mean_measured - scale * mean_model
+        rms_error_s = (sum((offset_s + scale * m - t)**2
+                           for m, t in zip(model_s, measured_s)) / n)**0.5
+        self._motion_calibration[ch] = (scale, offset_s)
+        self._motion_calibrated[ch] = True
+        self._loggers[ch].info(
+            '%s(ch%s): -> scale = %0.3f, offset = %0.1fms '
+            '(rms error %0.1fms)',
+            self.name, ch, scale, 1e3 * offset_s, 1e3 * rms_error_s)
+        return {'scale': scale,
+                'offset_s': offset_s,
+                'rms_error_s': rms_error_s}
+
+    def _poll_delay_s(self, ch, strategy):
+        # how long to sleep before the next status poll of a moving channel:
+        if strategy == 'busy':
+            return 0
+        if (strategy == 'fixed' or self._move_t0[ch] is None or
+            not self._motion_calibrated[ch]): # (stage units are assumed)
+            return self.poll_interval_s
+        # 'model': sleep through most of the move then poll densely near the
+        # predicted arrival (and at the fixed interval if the move is late),
+        # once 'calibrate_motion_model' has checked the model:
+        remaining_s = (self._move_t0[ch] + self._move_time_s[ch] -
+                       time.perf_counter())
+        if remaining_s < 0:
+            return self.poll_interval_s
+        guard_s = 0.05 * self._move_time_s[ch] + self.poll_interval_s
+        if remaining_s > guard_s: # max sleep bounds a wrong model:
+            return min(remaining_s - guard_s, 0.5)
+        return 0.1 * self.poll_interval_s
+
+    def _finish_moving(self, ch, strategy=None):
+        self.finish_moving_many((ch,), strategy=strategy)
         return None
 
+    def iter_finish_moving(self,
+                           channels=None,
+                           timeout=None,
+                           strategy=None,
+                           progress=None, # called as progress(ch, count)
+                           tolerance_counts=None):
+        '''
+        Poll all the busy 'channels' round-robin in one loop (each when its
+        wait strategy says so) and yield each channel as it finishes. One
+        overall 'timeout' (s) covers the whole wait: TimeoutError is raised
+        if any channel is still moving when it runs out. 'progress(ch,
+        encoder_count)' is called after every status poll. With
+        'tolerance_counts' a channel also finishes as soon as its encoder
+        is within that many counts of the target (still 'moving' e.g.
+        during the final creep of a move).
+        '''
+        if channels is None: channels = self.channels
+        if strategy is None: strategy = self.wait_strategy
+        assert strategy in ('busy', 'fixed', 'model')
+        for ch in channels:
+            assert ch in self.channels, (
+                "%s: channel (%s) not available"%(self.name, ch))
+        if self._pending_mm: # wait for the latest targets
+            self._flush_coalesced(channels)
+        t0, cpu_t0 = time.perf_counter(), time.thread_time()
+        deadline = None if timeout is None else t0 + timeout
+        next_poll, status_calls = {}, {}
+        with self._handles_cond: # the handle waiter leaves these to us
+            for ch in channels:
+                self._waiting[ch] += 1
+        try:
+            for ch in channels:
+                status_calls[ch] = 0
+                if self._moving[ch]:
+                    next_poll[ch] = t0 + self._poll_delay_s(ch, strategy)
+            for ch in channels:
+                if not self._moving[ch]:
+                    self.wait_stats[ch] = {'strategy': strategy,
+                                           'status_calls': 0,
+                                           'cpu_s': 0,
+                                           'wall_s': 0}
+                    yield ch
+            while next_poll:
+                ch = min(next_poll, key=next_poll.get) # next channel due
+                poll_time = next_poll[ch]
+                if deadline is not None and poll_time > deadline:
+                    poll_time = deadline
+                delay_s = poll_time - time.perf_counter()
+                if delay_s > 0:
+                    time.sleep(delay_s)
+                if deadline is not None and time.perf_counter() >= deadline:
+                    raise TimeoutError(
+                        "%s: channels %s still moving after %ss"%(
+                            self.name, tuple(next_poll), timeout))
+                max_age = None # use the poller's status if recent
+                if self._poller is not None:
+                    max_age = self._poller_period_s
+                self._poll_moving(ch, max_age)
+                status_calls[ch] += 1
+                if progress is not None:
+                    progress(ch, self._encoder_count[ch])
+                if self._moving[ch] and not (
+                    tolerance_counts is not None and
+                    self._target_count[ch] is not None and
+                    abs(self._encoder_count[ch] - self._target_count[ch]) <=
+                    tolerance_counts):
+                    next_poll[ch] = (
+                        time.perf_counter() + self._poll_delay_s(ch, strategy))
+                    continue
+                next_poll.pop(ch)
+                self.wait_stats[ch] = {'strategy': strategy,
+                                       'status_calls': status_calls[ch],
+                                       'cpu_s': time.thread_time() - cpu_t0,
+                                       'wall_s': time.perf_counter() - t0}
+                self._loggers[ch].info(
+                    '%s(ch%s): -> finished moving '
+                    '(%i status calls, %0.1fms cpu)', self.name, ch,
+                    status_calls[ch], 1e3 * self.wait_stats[ch]['cpu_s'])
+                yield ch
+        finally: # one span per wait loop
+            with self._handles_cond:
+                for ch in channels:
+                    self._waiting[ch] -= 1
+                self._handles_cond.notify_all()
+            if self._tracer is not None:
+                self._tracer.complete(
+                    'finish_moving', 'wait', t0, time.perf_counter(),
+                    args={'channels': list(channels),
+                          'strategy': strategy,
+                          'status_calls': status_calls})
+
+    def finish_moving_many(self,
+                           channels=None,
+                           timeout=None,
+                           callback=None, # called as callback(ch)
+                           strategy=None,
+                           progress=None, # called as progress(ch, count)
+                           tolerance_counts=None):
+        '''
+        Wait for all 'channels' to finish moving in one interleaved polling
+        loop (see 'iter_finish_moving'). 'callback(ch)' is called as each
+        channel finishes. Returns the channels in the order they finished.
+        'wait_stats[ch]["cpu_s"]' is the CPU used by the shared loop.
+        '''
+        finished = []
+        for ch in self.iter_finish_moving(
+            channels, timeout, strategy, progress, tolerance_counts):
+            finished.append(ch)
+            if callback is not None:
+                callback(ch)
+        return tuple(finished)
+
+    wait_all = finish_moving_many
+
     def _home(self, ch, block=True):
-        if self.verbose:
-            print("%s(ch%s): homing..."%(self.name, ch))
+        self._loggers[ch].info('%s(ch%s): homing...', self.name, ch)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
-        dll.home(self.hdl, self.ch_to_slot[ch])
+        t_issue = time.perf_counter()
+        self.dll.home(self.hdl, self.ch_to_slot[ch]) # home is at count 0:
+        self._target_mm[ch] = 0
+        if self._tracer is not None:
+            self._tracer.begin_move(ch, 'home', t_issue, time.perf_counter())
+        self._predict_move(
+            ch, 1e-6 * self._nm_per_count[ch] * abs(self._encoder_count[ch]))
+        self._watch(ch, None, deadline=False) # (see 'home_all' timeout)
         self._moving[ch] = True
         if block:
             self._finish_moving(ch)
         return None
 
+    def home_all(self,
+                 channels=None,
+                 timeout=None, # s per channel, None waits forever
+                 progress=None, # called as progress(ch, encoder_count)
+                 block=True):
+        '''
+        Home 'channels' together: the home commands go back to back and one
+        interleaved loop waits for all of them. Returns {ch: threading.Event}
+        with each event set as its channel finishes homing (also stored in
+        'homed_events'). 'progress(ch,
+        encoder_count)' is called on every status poll. A channel still
+        homing after 'timeout' is stopped and TimeoutError is raised
+        (naming every late channel). With 'block=False' the wait runs on a
+        background thread and returns at once: wait on the events before
+        using those channels, a timeout is logged and kept in
+        'homing_errors[ch]' instead of raised.
+        '''
+        if channels is None: channels = self.channels
+        channels = tuple(channels)
+        events = {ch: threading.Event() for ch in channels}
+        self.homed_events.update(events)
+        for ch in channels:
+            self.homing_errors.pop(ch, None)
+            self._home(ch, block=False) # send home commands back to back
+        if not block:
+            threading.Thread(
+                target=self._finish_homing,
+                args=(channels, timeout, progress, events, False),
+                name='%s homing'%self.name,
+                daemon=True).start()
+            return events
+        self._finish_homing(channels, timeout, progress, events, True)
+        return events
+
+    def _finish_homing(self, channels, timeout, progress, events, raise_error):
+        t0, homing, errors = time.perf_counter(), list(channels), []
+        while homing:
+            timeout_s = None
+            if timeout is not None:
+                timeout_s = max(timeout - (time.perf_counter() - t0), 0)
+            try:
+                self.finish_moving_many(
+                    homing, timeout_s, lambda ch: events[ch].set(),
+                    progress=progress)
+                break
+            except MoveTimeoutError as e: # stalled (stopped), wait for rest
+                self.homing_errors[e.ch] = e
+                errors.append(e)
+                homing = [ch for ch in homing
+                          if ch != e.ch and not events[ch].is_set()]
+            except TimeoutError:
+                for ch in homing:
+                    if events[ch].is_set():
+                        continue
+                    self._stop(ch)
+                    self._get_status(ch) # where it stopped
+                    self.homing_errors[ch] = TimeoutError(
+                        "%s(ch%s): homing did not finish after %ss "
+                        "(encoder_count=%i, stopped)"%(
+                            self.name, ch, timeout, self._encoder_count[ch]))
+                    self._loggers[ch].error('%s', self.homing_errors[ch])
+                    errors.append(self.homing_errors[ch])
+                break
+        if errors and raise_error:
+            if len(errors) == 1:
+                raise errors[0]
+            raise TimeoutError('; '.join(str(e) for e in errors))
+        return None
+
+    def stop(self, ch):
+        # stop a channel now, safe from any thread (with 'thread_safe=True'
+        # the 'MoveStop' goes ahead of any queued commands):
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        self._stop(ch)
+        return None
+
     def _stop(self, ch):
-        if self.very_verbose:
-            print("%s(ch%s): stopping"%(self.name, ch))
-        dll.stop(self.hdl, self.ch_to_slot[ch])
-        if self.very_verbose:
-            print("%s(ch%s): -> done stopping"%(self.name, ch))
+        self._loggers[ch].debug('%s(ch%s): stopping', self.name, ch)
+        with self._flush_lock: # (not while the coalescer sends a target)
+            with self._coalesce_lock: # drop a pending target, never sent
+                self._pending_mm.pop(ch, None)
+                self._pending_from_mm.pop(ch, None)
+                handles = self._pending_handles.pop(ch, [])
+            self.dll.stop(self.hdl, self.ch_to_slot[ch])
+            self._target_mm[ch] = None # see '_settled'
+            self._predict_move(ch, 0) # stopping -> poll at the fixed rate
+            self._watch(ch, None) # no stall check, just 'watchdog_margin_s'
+        for handle in handles:
+            Future.cancel(handle)
+        with self._handles_cond: # (the handle waiter reschedules)
+            self._handles_cond.notify_all()
+        self._loggers[ch].debug(
+            '%s(ch%s): -> done stopping', self.name, ch)
         return None
 
     def set_velocity(self, ch, velocity_pct):
 ##        ***currently not working and causing move to limit switch!***
-        print("%s(ch%s): ***ERROR*** setting velocity"%(self.name, ch))
+        self._loggers[ch].error(
+            '%s(ch%s): ***ERROR*** setting velocity', self.name, ch)
         return None
-        if self.verbose:
-            print("%s(ch%s): setting velocity = %s%%"%(
-                self.name, ch, velocity_pct))
+        self._loggers[ch].info(
+            '%s(ch%s): setting velocity = %s%%', self.name, ch, velocity_pct)
         assert 0 <= velocity_pct <= 100
-        dll.set_velocity(self.hdl, self.ch_to_slot[ch], 0, velocity_pct)
-        if self.verbose:
-            print("%s(ch%s): -> done setting velocity"%(self.name, ch))
+        self.dll.set_velocity(self.hdl, self.ch_to_slot[ch], 0, velocity_pct)
+        self._loggers[ch].info(
+            '%s(ch%s): -> done setting velocity', self.name, ch)
         return None
 
-    def get_position_mm(self, ch):
-        if self.verbose:
-            print("%s(ch%s): getting position"%(self.name, ch))
+    def get_position_mm(self, ch, max_age=None):
+        # max_age=None converts the last known encoder count, otherwise the
+        # status is refreshed if the cached one is older than max_age (s):
+        self._loggers[ch].info('%s(ch%s): getting position', self.name, ch)
         assert ch in self.channels, (
             "%s: channel (%s) not available"%(self.name, ch))
-        nm = C.c_double()
-        dll.get_position(
-            self.hdl, self.ch_to_slot[ch], self._encoder_count[ch], nm)
-        self.position_mm[ch] = round(1e-6 * nm.value, 3)
-        if self.verbose:
-            print("%s(ch%s): = %7.3f"%(self.name, ch, self.position_mm[ch]))
+        if max_age is not None:
+            self._get_status(ch, max_age)
+        nm = self._get_nm(ch, self._encoder_count[ch])
+        self.position_mm[ch] = round(1e-6 * nm, 3)
+        self._loggers[ch].info(
+            '%s(ch%s): = %7.3f', self.name, ch, self.position_mm[ch])
         return self.position_mm[ch]
 
     def move_mm(self, ch, position_mm, relative=True, block=True):
-        if self.verbose:
-            print("%s(ch%s): moving to %10.06fmm (relative=%s)"%(
-                self.name, ch, position_mm, relative))
-        if relative: position_mm = self.position_mm[ch] + position_mm
+        # with 'block=False' returns a 'MoveHandle' (a Future):
+        return self._move_mm(ch, position_mm, relative, block, not block)
+
+    def _move_mm(self, ch, position_mm, relative, block, handle):
+        # 'handle=False' issues the move without a 'MoveHandle' so nothing
+        # polls in the background (see 'AsyncController'):
+        self._loggers[ch].info(
+            '%s(ch%s): moving to %10.06fmm (relative=%s)',
+            self.name, ch, position_mm, relative)
+        if relative: position_mm = self._get_target_mm(ch) + position_mm
         if not self.min_mm[ch] <= position_mm <= self.max_mm[ch]:
-            if self.verbose:
-                print('%s: ***WARNING*** -> move out of limits'%self.name)
+            self.logger.warning(
+                '%s: ***WARNING*** -> move out of limits', self.name)
+            return None
+        handles = [MoveHandle(self, ch, position_mm)] if handle else []
+        if self.coalesce_s is not None:
+            if not block:
+                self._coalesce(ch, position_mm, handles)
+                return handles[0] if handles else None
+            handles = self._drop_coalesced((ch,))[ch]
+        self._move(ch, self._get_encoder_count(ch, position_mm), position_mm,
+                   handles=handles)
+        if block:
+            self._finish_moving(ch)
+            return None
+        return handles[0] if handles else None
+
+    def move_mm_many(self, positions_mm, relative=False, block=True):
+        '''
+        Move several channels together e.g. {0: 1.5, 1: -2.0}. All targets
+        are checked against 'min_mm'/'max_mm' and converted before any move
+        is sent, then the 'MoveAbsolute' commands go back to back so the
+        axes run at the same time, followed by one combined wait if 'block'.
+        With 'block=False' returns {ch: MoveHandle}.
+        '''
+        self.logger.info(
+            '%s: moving to %s mm (relative=%s)',
+            self.name, positions_mm, relative)
+        targets_mm = {}
+        for ch, position_mm in positions_mm.items():
+            assert ch in self.channels, (
+                "%s: channel (%s) not available"%(self.name, ch))
+            if relative: position_mm = self._get_target_mm(ch) + position_mm
+            if not self.min_mm[ch] <= position_mm <= self.max_mm[ch]:
+                self._loggers[ch].warning(
+                    '%s(ch%s): ***WARNING*** -> move out of limits '
+                    '(no channels moved)', self.name, ch)
+                return None
+            targets_mm[ch] = position_mm
+        encoder_counts = {ch: self._get_encoder_count(ch, position_mm)
+                          for ch, position_mm in targets_mm.items()}
+        handles = {ch: [] for ch in targets_mm}
+        if self.coalesce_s is not None:
+            handles = self._drop_coalesced(tuple(targets_mm))
+        if not block:
+            for ch, position_mm in targets_mm.items():
+                handles[ch].append(MoveHandle(self, ch, position_mm))
+        for ch, position_mm in targets_mm.items(): # issue back to back
+            self._move(ch, encoder_counts[ch], position_mm,
+                       handles=handles[ch])
+        if block:
+            self.finish_moving_many(tuple(targets_mm))
             return None
+        return {ch: handles[ch][-1] for ch in targets_mm}
+
+    def set_jog_step_mm(self, ch, step_mm, save=False):
+        '''
+        Program the hardware jog step ('SetJogParams', in encoder counts)
+        once for 'jog'. With 'save=True' it is also stored in the EEPROM
+        ('SetEEPROMPARAMSJogParams'). Returns the step size in mm after
+        rounding to whole counts.
+        '''
+        self._loggers[ch].info(
+            '%s(ch%s): setting jog step = %0.6fmm', self.name, ch, step_mm)
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        step_counts = abs(self._get_encoder_count(ch, abs(step_mm)))
+        assert step_counts > 0, (
+            "%s(ch%s): jog step below one encoder count"%(self.name, ch))
+        self.dll.set_jog_params(self.hdl, self.ch_to_slot[ch], step_counts)
+        if save:
+            self.dll.save_jog_params(self.hdl, self.ch_to_slot[ch])
+        self._jog_step_counts[ch] = self._get_jog_step_counts(ch)
+        assert self._jog_step_counts[ch] == step_counts, (
+            "%s(ch%s): jog step readback (%s) != %s counts"%(
+                self.name, ch, self._jog_step_counts[ch], step_counts))
+        self._jog_count[ch] = None # reconcile on the next jog
+        step_mm = 1e-6 * self._get_nm(ch, step_counts)
+        self._loggers[ch].info(
+            '%s(ch%s): -> done setting jog step (%i counts = %0.6fmm)',
+            self.name, ch, step_counts, step_mm)
+        return step_mm
+
+    def _get_jog_step_counts(self, ch):
+        step_size = C.c_uint()
+        self.dll.get_jog_params(self.hdl, self.ch_to_slot[ch], step_size)
+        return step_size.value
+
+    def jog(self, ch, steps=1, block=True):
+        '''
+        Move 'steps' jog steps (negative for the negative direction) with
+        one 'MoveJog' per step and no position conversion: each step
+        starts once the previous one settled. The position is tracked by
+        counting steps and reconciled with the encoder every
+        'jog_reconcile_steps' (and after any other move or stop), any
+        drift is logged and kept in 'jog_stats[ch]' with the steps/s. With
+        'block=False' the last step returns a 'MoveHandle'.
+        'MoveJog' direction 1 ('Clockwise') is assumed to be the positive
+        encoder direction: the first step after any other command is
+        checked against the encoder, and jogging stops with an error if
+        the encoder is more than one step from the counted position.
+        '''
+        self._loggers[ch].info(
+            '%s(ch%s): jogging %i steps', self.name, ch, steps)
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        step_counts = self._jog_step_counts[ch]
+        assert step_counts is not None, (
+            "%s(ch%s): call 'set_jog_step_mm' first"%(self.name, ch))
+        if self.coalesce_s is not None: # jog from the latest target
+            self._flush_coalesced((ch,))
+        direction, sign = (1, 1) if steps > 0 else (0, -1)
+        step_mm = 1e-6 * self._nm_per_count[ch] * step_counts
+        slot, logger = self.ch_to_slot[ch], self._loggers[ch]
+        handle, drift_counts, t0 = None, 0, time.perf_counter()
+        for i in range(abs(steps)):
+            if self._moving[ch]:
+                self._finish_moving(ch)
+            if (self._jog_count[ch] is None or # not jogging before
+                self._jog_count[ch] != self._target_count[ch] or
+                self._jog_steps[ch] >= self.jog_reconcile_steps):
+                drift_counts += self._reconcile_jog(ch)
+            encoder_count = self._jog_count[ch] + sign * step_counts
+            position_mm = 1e-6 * self._nm_per_count[ch] * encoder_count
+            if not self.min_mm[ch] <= position_mm <= self.max_mm[ch]:
+                self.logger.warning(
+                    '%s: ***WARNING*** -> jog out of limits', self.name)
+                break
+            logger.debug('%s(ch%s): jog step %i', self.name, ch, i)
+            if not block and i == abs(steps) - 1:
+                handle = MoveHandle(self, ch, position_mm)
+            t_issue = time.perf_counter()
+            self.dll.move_jog(self.hdl, slot, direction)
+            if self._tracer is not None:
+                self._tracer.begin_move(
+                    ch, 'jog', t_issue, time.perf_counter(),
+                    {'position_mm': position_mm,
+                     'encoder_count': encoder_count})
+            self._predict_move(ch, step_mm)
+            self._watch(ch, encoder_count)
+            self._jog_count[ch] = encoder_count
+            self._jog_steps[ch] += 1
+            self._target_mm[ch] = position_mm
+            if handle is not None:
+                self._add_handles(ch, (handle,))
+            self._moving[ch] = True
+        if block and self._moving[ch]:
+            self._finish_moving(ch)
+        total_s = time.perf_counter() - t0
+        self.jog_stats[ch] = {'steps': abs(steps),
+                              'total_s': total_s,
+                              'steps_per_s': abs(steps) / total_s,
+                              'drift_counts': drift_counts}
+        logger.info('%s(ch%s): -> done jogging (%0.1f steps/s)',
+                    self.name, ch, self.jog_stats[ch]['steps_per_s'])
+        return handle
+
+    def _reconcile_jog(self, ch):
+        # re-base the counted jog position on the encoder, returns the
+        # drift since the last reconciliation (0 after another command):
+        self._get_status(ch)
+        drift_counts = 0
+        jogging = (self._jog_count[ch] is not None and # (None: not yet,
+                   self._jog_count[ch] == self._target_count[ch]) # or stop)
+        if jogging:
+            drift_counts = self._encoder_count[ch] - self._jog_count[ch]
+            if drift_counts:
+                self._loggers[ch].warning(
+                    '%s(ch%s): jog drifted %i counts from the counted '
+                    'position', self.name, ch, drift_counts)
+        self._jog_count[ch] = self._encoder_count[ch]
+        self._jog_steps[ch] = 0
+        if not jogging: # check the direction after the first step
+            self._jog_steps[ch] = self.jog_reconcile_steps - 1
+        if abs(drift_counts) > self._jog_step_counts[ch]:
+            self._jog_count[ch] = None # (re-base on the next jog)
+        assert abs(drift_counts) <= self._jog_step_counts[ch], (
+            "%s(ch%s): jog is %i counts from the counted position "
+            "(more than one step, wrong 'MoveJog' direction?)"%(
+                self.name, ch, drift_counts))
+        return drift_counts
+
+    def _get_encoder_count(self, ch, position_mm):
+        rounding = self._local_rounding[ch]
+        if rounding is not None:
+            return _ROUNDING[rounding](
+                1e6 * position_mm / self._nm_per_count[ch])
         encoder_count = C.c_int()
-        dll.get_encoder_count(
+        self.dll.get_encoder_count(
             self.hdl, self.ch_to_slot[ch], 1e6 * position_mm, encoder_count)
-        dll.move(self.hdl, self.ch_to_slot[ch], encoder_count.value)
+        return encoder_count.value
+
+    def _coalesce(self, ch, position_mm, handles):
+        # Keep only the latest target of each channel, the '_coalescer'
+        # thread sends it at most every 'coalesce_s' and only once the
+        # previous 'MoveAbsolute' returned. It is the target straight away
+        # so relative moves add up as usual:
+        with self._coalesce_lock:
+            if ch in self._pending_mm:
+                self.coalesced[ch] += 1
+            else:
+                self._pending_from_mm[ch] = self._target_mm[ch]
+            self._pending_mm[ch] = position_mm
+            self._pending_handles.setdefault(ch, []).extend(handles)
+            self._target_mm[ch] = position_mm
+            self._coalesce_event.set()
+            if self._coalescer is None:
+                self._coalescer = threading.Thread(
+                    target=self._send_coalesced,
+                    name='%s coalescer'%self.name,
+                    daemon=True)
+                self._coalescer.start()
+        return None
+
+    def _send_coalesced(self):
+        while True:
+            self._coalesce_event.wait()
+            with self._coalesce_lock:
+                if self._coalescer is None: # see 'close'
+                    return None
+                if not self._pending_mm:
+                    self._coalesce_event.clear()
+                    continue
+                due = {ch: (self._move_t0[ch] or 0) + self.coalesce_s
+                       for ch in self._pending_mm}
+            ch = min(due, key=due.get)
+            delay_s = due[ch] - time.perf_counter()
+            if delay_s > 0: # later targets just replace the pending one
+                time.sleep(delay_s)
+            self._flush_coalesced((ch,))
+
+    def _flush_coalesced(self, channels):
+        # send any pending targets of 'channels' now (e.g. before a wait):
+        for ch in channels:
+            with self._flush_lock: # (a stop waits, then drops newer ones)
+                with self._coalesce_lock:
+                    position_mm = self._pending_mm.pop(ch, None)
+                    from_mm = self._pending_from_mm.pop(ch, None)
+                    handles = self._pending_handles.pop(ch, [])
+                if position_mm is None:
+                    continue
+                self._move(ch, self._get_encoder_count(ch, position_mm),
+                           position_mm, from_mm, handles)
+                with self._coalesce_lock: # a newer target may be pending
+                    self._target_mm[ch] = self._pending_mm.get(
+                        ch, position_mm)
+        return None
+
+    def _drop_coalesced(self, channels):
+        # pending targets superseded by a blocking or multi-axis move,
+        # returns their handles (to complete with the new move) per ch:
+        handles = {}
+        with self._coalesce_lock:
+            for ch in channels:
+                handles[ch] = self._pending_handles.pop(ch, [])
+                if self._pending_mm.pop(ch, None) is not None:
+                    self._pending_from_mm.pop(ch)
+                    self.coalesced[ch] += 1
+        return handles
+
+    def _move(self, ch, encoder_count, position_mm, from_mm=None,
+              handles=()):
+        if from_mm is None: from_mm = self._target_mm[ch]
+        if from_mm is None: # stopped -> from where it is now (the watchdog
+            self._get_status(ch) # deadline needs the real distance)
+            from_mm = 1e-6 * self._get_nm(ch, self._encoder_count[ch])
+        t_issue = time.perf_counter()
+        self.dll.move(self.hdl, self.ch_to_slot[ch], encoder_count)
+        if self._tracer is not None:
+            self._tracer.begin_move(
+                ch, 'move', t_issue, time.perf_counter(),
+                {'position_mm': position_mm, 'encoder_count': encoder_count})
+        self._predict_move(ch, abs(position_mm - from_mm))
+        self._watch(ch, encoder_count)
+        self._target_mm[ch] = position_mm
+        self._add_handles(ch, handles)
         self._moving[ch] = True
-        self.position_mm[ch] = position_mm
+        return None
+
+    def _add_handles(self, ch, handles):
+        if handles: # completed by '_settled'
+            with self._handles_cond:
+                self._handles.setdefault(ch, []).extend(handles)
+                if self._handle_waiter is None:
+                    self._handle_waiter = threading.Thread(
+                        target=self._wait_for_handles,
+                        name='%s handle waiter'%self.name,
+                        daemon=True)
+                    self._handle_waiter.start()
+                self._handles_cond.notify_all()
+        return None
+
+    def _wait_for_handles(self):
+        # background poll of the channels with pending 'MoveHandle's that
+        # no wait loop is polling already ('_settled' completes them):
+        next_poll, move_t0 = {}, {} # (reschedule after a new move or stop)
+        with self._handles_cond:
+            while self._handle_waiter is not None: # see 'close'
+                for ch in tuple(next_poll):
+                    if (ch not in self._handles or self._waiting[ch] or
+                        move_t0[ch] != self._move_t0[ch]):
+                        next_poll.pop(ch)
+                for ch in self._handles:
+                    if ch not in next_poll and not self._waiting[ch]:
+                        move_t0[ch] = self._move_t0[ch]
+                        next_poll[ch] = time.perf_counter() + (
+                            self._poll_delay_s(ch, self.wait_strategy))
+                if not next_poll:
+                    self._handles_cond.wait()
+                    continue
+                ch = min(next_poll, key=next_poll.get)
+                delay_s = next_poll[ch] - time.perf_counter()
+                if delay_s > 0:
+                    self._handles_cond.wait(delay_s)
+                    continue
+                max_age = None # use the poller's status if recent
+                if self._poller is not None:
+                    max_age = self._poller_period_s
+                self._handles_cond.release()
+                try:
+                    self._poll_moving(ch, max_age)
+                except Exception as e: # fail the handles, keep running
+                    with self._handles_cond:
+                        handles = self._handles.pop(ch, ())
+                    for handle in handles:
+                        handle.set_exception(e)
+                finally:
+                    self._handles_cond.acquire()
+                next_poll[ch] = time.perf_counter() + (
+                    self._poll_delay_s(ch, self.wait_strategy))
+        return None
+
+    def get_state(self, ch, max_age=0.1):
+        '''
+        Encoder count and enabled/homed/moving flags of a channel as a dict,
+        served from the background poller (or the last status read) when
+        younger than 'max_age' (s), otherwise read synchronously. 'age_s'
+        is the age of the returned values.
+        '''
+        assert ch in self.channels, (
+            "%s: channel (%s) not available"%(self.name, ch))
+        snapshot = self._get_snapshot(ch, max_age)
+        if snapshot is None:
+            snapshot = self._read_status(ch)
+        state = dict(snapshot)
+        state['age_s'] = time.perf_counter() - state.pop('t')
+        return state
+
+    def start_poller(self, rate_hz=20, channels=None):
+        '''
+        Refresh the status of 'channels' in a background thread at up to
+        'rate_hz' so several readers (GUI, logger, scan loop) can share it
+        via 'get_state', 'get_position_mm(max_age=...)' and the waits.
+        '''
+        assert rate_hz > 0
+        if channels is None: channels = self.channels
+        for ch in channels:
+            assert ch in self.channels, (
+                "%s: channel (%s) not available"%(self.name, ch))
+        self.stop_poller()
+        self.logger.info(
+            '%s: starting status poller (%0.1fHz)', self.name, rate_hz)
+        self._poller_period_s = 1 / rate_hz
+        self._poller_stop = threading.Event()
+        self._poller = threading.Thread(
+            target=self._poll, args=(tuple(channels),), daemon=True)
+        self._poller.start()
+        return None
+
+    def _poll(self, channels):
+        period_s, stop = self._poller_period_s, self._poller_stop
+        t_next = time.perf_counter()
+        while not stop.is_set():
+            for ch in channels:
+                self._read_status(ch)
+            t_next = max(t_next + period_s, time.perf_counter())
+            stop.wait(t_next - time.perf_counter())
+        return None
+
+    def stop_poller(self):
+        if self._poller is None:
+            return None
+        self._poller_stop.set()
+        self._poller.join()
+        self._poller = None
+        self.logger.info('%s: stopped status poller', self.name)
+        return None
+
+    def start_stream(self, channels=None, rate_hz=None, capacity=100000):
+        '''
+        Sample the status of 'channels' in a background thread as fast as
+        the link allows (or at up to 'rate_hz' sweeps/s) into a numpy ring
+        buffer of 'capacity' samples, e.g. to trace overshoot and settling
+        during a move. Returns the 'StatusStream', see 'StatusStream.stop'.
+        '''
+        if channels is None: channels = self.channels
+        for ch in channels:
+            assert ch in self.channels, (
+                "%s: channel (%s) not available"%(self.name, ch))
+        assert rate_hz is None or rate_hz > 0
+        stream = StatusStream(self, tuple(channels), rate_hz, capacity)
+        self._streams.append(stream)
+        self.logger.info('%s: started status stream %s', self.name, channels)
+        return stream
+
+    def record_log(self, capacity=10000, level=logging.DEBUG):
+        '''
+        Keep the last 'capacity' log records at 'level' in memory (e.g. to
+        see what led up to a fault) without printing them: any existing
+        handlers keep their current level. Returns the 'RingBufferHandler'.
+        '''
+        for handler in self.logger.handlers:
+            if handler.level == logging.NOTSET:
+                handler.setLevel(self.logger.getEffectiveLevel())
+        ring_buffer = RingBufferHandler(capacity)
+        ring_buffer.setLevel(level)
+        self.logger.addHandler(ring_buffer)
+        if level < self.logger.getEffectiveLevel():
+            self.logger.setLevel(level)
+        return ring_buffer
+
+    def enable_metrics(self, enabled=True):
+        '''
+        Count the calls and errors and time every .dll call, per function
+        and slot (see 'metrics'). Enabling resets the metrics. Disabled (the
+        default) the calls go straight to the backend with no overhead.
+        '''
+        with self.dll.lock:
+            self._call_histograms = {} if enabled else None
+            self._wrap_backend()
+        return None
+
+    def _wrap_backend(self):
+        # rebuild the optional proxies in front of the backend, keeping the
+        # same lock or command queue (call with 'self.dll.lock' held):
+        backend = self._backend
+        if self._call_histograms is not None:
+            backend = _MeteredBackend(backend, self._call_histograms)
+        if self._tracer is not None:
+            backend = _TracedBackend(backend, self._tracer)
+        if isinstance(self.dll, _QueuedBackend):
+            self.dll = _QueuedBackend(backend, self.dll.commands)
+        else:
+            self.dll = _LockedBackend(backend, self.dll.lock)
+        return None
+
+    def metrics(self, format='dict'):
+        '''
+        The .dll call metrics since 'enable_metrics' as:
+        - 'dict': {function: {slot: {'count', 'errors', 'total_s', 'p50_s',
+          'p95_s', 'p99_s', 'max_s'}}} (slot None for calls without one),
+          quantiles are the upper edge of their histogram bucket
+        - 'json': the same as a JSON string
+        - 'prometheus': histograms in the Prometheus text exposition format
+        '''
+        assert format in ('dict', 'json', 'prometheus')
+        assert self._call_histograms is not None, (
+            "%s: metrics not enabled (see 'enable_metrics')"%self.name)
+        with self.dll.lock: # consistent copy
+            histograms = {key: histogram.copy() for key, histogram
+                          in self._call_histograms.items()}
+        if format == 'prometheus':
+            return _prometheus_text(self.name, histograms)
+        metrics = {}
+        for (function, slot), histogram in sorted(
+            histograms.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            metrics.setdefault(function, {})[slot] = histogram.summary()
+        if format == 'json':
+            return json.dumps(metrics, indent=1)
+        return metrics
+
+    def start_trace(self, capacity=100000):
+        '''
+        Record a timeline of the controller activity into a ring buffer of
+        the last 'capacity' events: every .dll call (on the calling thread),
+        every move and homing (issue -> moving -> settled, one track per
+        channel) and every wait loop. Save with 'dump_trace' and open in
+        Perfetto (ui.perfetto.dev) or chrome://tracing to see if channels
+        overlap, where the polling gaps are and how long the serial link
+        is busy.
+        '''
+        with self.dll.lock:
+            self._tracer = _Tracer(self.name, capacity)
+            self._wrap_backend()
+        self.logger.info('%s: tracing (capacity=%i)', self.name, capacity)
+        return None
+
+    def stop_trace(self):
+        # stop recording, the events are kept until the next 'start_trace':
+        with self.dll.lock:
+            tracer, self._tracer = self._tracer, None
+            self._wrap_backend()
+        self._last_tracer = tracer
+        return None
+
+    def dump_trace(self, filename=None):
+        '''
+        The recorded events in the Chrome trace event format (a dict), also
+        written as JSON to 'filename' if given.
+        '''
+        tracer = self._tracer
+        if tracer is None: tracer = self._last_tracer
+        assert tracer is not None, (
+            "%s: no trace recorded (see 'start_trace')"%self.name)
+        trace = tracer.trace(self.channels)
+        if filename is not None:
+            with open(filename, 'w') as file:
+                json.dump(trace, file)
+            self.logger.info(
+                '%s: trace saved (%i events) to %s',
+                self.name, len(trace['traceEvents']), filename)
+        return trace
+
+    def close(self):
+        self._stop_threads()
+        if self._session_cache is not None: # e.g. keep the calibration
+            self._save_session()
+        self.logger.info('%s: closing...', self.name)
+        self._close_handle()
+        self.logger.info('%s: -> closed.', self.name)
+        return None
+
+    def _stop_threads(self):
+        # poller, streams, coalescer and handle waiter (see 'close'):
+        self.stop_poller()
+        for stream in tuple(self._streams):
+            stream.stop()
+        if self._coalescer is not None: # send the latest targets and stop
+            self._flush_coalesced(self.channels)
+            with self._coalesce_lock:
+                coalescer, self._coalescer = self._coalescer, None
+                self._coalesce_event.set()
+            coalescer.join()
+        with self._handles_cond: # stop the handle waiter
+            waiter, self._handle_waiter = self._handle_waiter, None
+            handles = [h for hs in self._handles.values() for h in hs]
+            self._handles.clear()
+            self._handles_cond.notify_all()
+        if waiter is not None:
+            waiter.join()
+        for handle in handles: # still moving
+            Future.cancel(handle)
+        return None
+
+    def _close_handle(self):
+        self.dll.close(self.hdl)
+        if isinstance(self.dll, _QueuedBackend):
+            self.dll.commands.shutdown()
+        return None
+
+class MoveTimeoutError(TimeoutError):
+    '''
+    Raised by the waits when the watchdog stops a channel: 'reason' is
+    'deadline' (later than the motion model allows) or 'stall' (encoder
+    not changing while the moving flags are set). 'detect_s' is the time
+    lost before the fault was detected (see 'Controller.watchdog_faults').
+    '''
+    def __init__(self, name, ch, reason, encoder_count, target_count,
+                 elapsed_s, detect_s):
+        self.name = name
+        self.ch = ch
+        self.reason = reason
+        self.encoder_count = encoder_count
+        self.target_count = target_count
+        self.elapsed_s = elapsed_s
+        self.detect_s = detect_s
+        super().__init__(
+            "%s(ch%s): move %s after %0.3fs (encoder_count=%s, target=%s), "
+            "channel stopped"%(name, ch, reason, elapsed_s, encoder_count,
+                               target_count))
+
+class MoveHandle(Future):
+    '''
+    Returned by the non-blocking moves ('move_mm(..., block=False)' etc.):
+    a 'concurrent.futures.Future' (works with 'concurrent.futures.wait'
+    and 'as_completed') whose result is the encoder verified position (mm)
+    once the stage has stopped. 'duration_s' is the time from issuing the
+    move to the status that showed it stopped. A background thread polls
+    the channel unless a wait loop is already doing so.
+    '''
+    def __init__(self, controller, ch, target_mm):
+        super().__init__()
+        self.controller = controller
+        self.ch = ch
+        self.target_mm = target_mm
+        self.t_issue = time.perf_counter()
+        self.duration_s = None
+        self.position_mm = None
+
+    def wait(self, timeout=None):
+        # the final position (mm), TimeoutError after 'timeout' (s):
+        return self.result(timeout)
+
+    def cancel(self):
+        # stop the channel ('MoveStop'), a target still pending in the
+        # coalescer is dropped (see 'Controller._stop'):
+        if self.done():
+            return False
+        self.controller.stop(self.ch)
+        return super().cancel()
+
+    def _settled(self, position_mm, t_settled):
+        self.position_mm = position_mm
+        self.duration_s = t_settled - self.t_issue
+        try:
+            self.set_result(position_mm)
+        except InvalidStateError: # cancelled
+            pass
+        return None
+
+class AsyncController:
+    '''
+    asyncio wrapper for 'Controller': every call on the handle runs on one
+    dedicated worker thread (so they stay serialized) and waits sleep with
+    'asyncio.sleep' between status polls, so moves on several stages can
+    overlap with other I/O without blocking the event loop. Create with
+    'controller = await AsyncController.create(sn=..., ...)' using the
+    'Controller' arguments.
+    '''
+    def __init__(self, controller, executor):
+        self.controller = controller
+        self.channels = controller.channels
+        self._executor = executor
+
+    @classmethod
+    async def create(cls, **controller_kwargs):
+        import asyncio # only needed here, keeps the import fast
+        executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='MCM301')
+        controller = await asyncio.get_running_loop().run_in_executor(
+            executor, partial(Controller, **controller_kwargs))
+        return cls(controller, executor)
+
+    async def _run(self, function, *args):
+        import asyncio # only needed here, keeps the import fast
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(function, *args))
+
+    async def get_position_mm(self, ch, max_age=None):
+        return await self._run(self.controller.get_position_mm, ch, max_age)
+
+    async def move_mm(self, ch, position_mm, relative=True, block=True):
+        await self._run( # (no 'MoveHandle': only this thread polls)
+            self.controller._move_mm, ch, position_mm, relative, False, False)
         if block:
-            self._finish_moving(ch)
+            await self.wait_all((ch,))
+        return None
+
+    async def home(self, ch, block=True):
+        await self._run(self.controller._home, ch, False)
+        if block:
+            await self.wait_all((ch,))
+        return None
+
+    async def wait_all(self, channels=None, timeout=None, callback=None):
+        '''
+        Awaitable 'Controller.finish_moving_many': polls the busy channels
+        round-robin with non-blocking sleeps, calls 'callback(ch)' as each
+        one finishes and returns the channels in the order they finished.
+        '''
+        import asyncio # only needed here, keeps the import fast
+        c = self.controller
+        if channels is None: channels = c.channels
+        if c._pending_mm: # wait for the latest targets
+            await self._run(c._flush_coalesced, channels)
+        t0 = time.perf_counter()
+        deadline = None if timeout is None else t0 + timeout
+        next_poll = {ch: t0 + c._poll_delay_s(ch, c.wait_strategy)
+                     for ch in channels if c._moving[ch]}
+        finished = [ch for ch in channels if ch not in next_poll]
+        while next_poll:
+            ch = min(next_poll, key=next_poll.get)
+            poll_time = next_poll[ch]
+            if deadline is not None and poll_time > deadline:
+                poll_time = deadline
+            await asyncio.sleep(max(poll_time - time.perf_counter(), 0))
+            if deadline is not None and time.perf_counter() >= deadline:
+                raise TimeoutError(
+                    "%s: channels %s still moving after %ss"%(
+                        c.name, tuple(next_poll), timeout))
+            max_age = None if c._poller is None else c._poller_period_s
+            await self._run(c._poll_moving, ch, max_age)
+            if c._moving[ch]:
+                next_poll[ch] = (
+                    time.perf_counter() + c._poll_delay_s(ch, c.wait_strategy))
+                continue
+            next_poll.pop(ch)
+            finished.append(ch)
+            c._loggers[ch].info('%s(ch%s): -> finished moving', c.name, ch)
+            if callback is not None:
+                callback(ch)
+        return tuple(finished)
+
+    async def close(self):
+        await self._run(self.controller.close)
+        self._executor.shutdown()
         return None
 
+class ControllerPool:
+    '''
+    Several MCM301 controllers used as one rig: the devices are listed
+    once and the controllers are opened (and homed) in parallel threads,
+    so bringing up N controllers takes about as long as one. Axes get
+    global names e.g. ControllerPool({'xy': {'sn': ..., ...}, 'z': {...}},
+    axes={'rig.x': ('xy', 0), 'rig.y': ('xy', 1), 'rig.z': ('z', 0)})
+    where each controller is given by its 'Controller' arguments (the
+    pool name is the default 'name'). Without 'axes' they are named
+    '<name>.ch<ch>'. 'devices' skips the listing (e.g. for simulators).
+    '''
+    def __init__(self, controllers, axes=None, devices=None, dll_path=None):
+        if devices is None:
+            devices = list_devices(load_dll(dll_path))
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(controllers), thread_name_prefix='MCM301Pool')
+        futures = {}
+        for name, kwargs in controllers.items():
+            kwargs = dict(kwargs)
+            kwargs.setdefault('name', name)
+            kwargs.setdefault('dll_path', dll_path)
+            futures[name] = self._executor.submit(
+                partial(Controller, devices=devices, **kwargs))
+        self.controllers, errors = {}, []
+        for name, future in futures.items():
+            try:
+                self.controllers[name] = future.result()
+            except Exception as e:
+                errors.append(e)
+        if errors: # close the ones that opened before raising
+            self.close()
+            raise errors[0]
+        if axes is None:
+            axes = {'%s.ch%i'%(name, ch): (name, ch)
+                    for name, c in self.controllers.items()
+                    for ch in c.channels}
+        for axis, (name, ch) in axes.items():
+            assert name in self.controllers, (
+                "pool: axis %s controller (%s) not in pool"%(axis, name))
+            assert ch in self.controllers[name].channels, (
+                "pool: axis %s channel (%s) not available"%(axis, ch))
+        self.axes = dict(axes)
+
+    def _by_controller(self, axes):
+        # {controller name: [channels]} for a sequence of axis names:
+        channels = {}
+        for axis in axes:
+            assert axis in self.axes, "pool: unknown axis (%s)"%axis
+            name, ch = self.axes[axis]
+            channels.setdefault(name, []).append(ch)
+        return channels
+
+    def get_position_mm(self, axis, max_age=None):
+        name, ch = self.axes[axis]
+        return self.controllers[name].get_position_mm(ch, max_age)
+
+    def move_many(self, positions_mm, relative=False, block=True):
+        '''
+        Move axes on any of the controllers together e.g. {'rig.x': 1.5,
+        'rig.z': -0.2}: each controller gets one 'move_mm_many' (all the
+        targets are checked by the controllers first), then one combined
+        'wait_all' if 'block'. With 'block=False' returns {axis: MoveHandle}.
+        '''
+        by_controller = {}
+        for axis, position_mm in positions_mm.items():
+            assert axis in self.axes, "pool: unknown axis (%s)"%axis
+            name, ch = self.axes[axis]
+            c = self.controllers[name]
+            if relative: position_mm = c._get_target_mm(ch) + position_mm
+            assert c.min_mm[ch] <= position_mm <= c.max_mm[ch], (
+                "pool: axis %s move out of limits (no axes moved)"%axis)
+            by_controller.setdefault(name, {})[ch] = position_mm
+        handles = {}
+        for name, targets_mm in by_controller.items():
+            for ch, handle in self.controllers[name].move_mm_many(
+                targets_mm, relative=False, block=False).items():
+                handles[(name, ch)] = handle
+        if block:
+            self.wait_all(tuple(positions_mm))
+            return None
+        return {axis: handles[self.axes[axis]] for axis in positions_mm}
+
+    def wait_all(self, axes=None, timeout=None):
+        '''
+        Wait for 'axes' (default: all) to finish moving, each controller
+        polling its own serial link in parallel. Returns the finished axes
+        (grouped by controller).
+        '''
+        if axes is None: axes = tuple(self.axes)
+        futures = {
+            name: self._executor.submit(
+                self.controllers[name].finish_moving_many,
+                tuple(channels), timeout)
+            for name, channels in self._by_controller(axes).items()}
+        axis_names = {v: k for k, v in self.axes.items()}
+        finished = []
+        for name, future in futures.items():
+            finished.extend(axis_names[(name, ch)] for ch in future.result())
+        return tuple(finished)
+
     def close(self):
-        if self.verbose: print("%s: closing..."%self.name, end='')
-        dll.close(self.hdl)
-        if self.verbose: print("done.")
+        futures = [self._executor.submit(c.close)
+                   for c in self.controllers.values()]
+        for future in futures:
+            future.result()
+        self._executor.shutdown()
         return None
 
-### Tidy and store DLL calls away from main program:
+def _move_time_s(distance_mm, max_speed, max_acceleration):
+    # time for a rest to rest move with a trapezoidal velocity profile:
+    if distance_mm <= 0:
+        return 0
+    if distance_mm >= max_speed**2 / max_acceleration: # reaches max_speed
+        return distance_mm / max_speed + max_speed / max_acceleration
+    return 2 * (distance_mm / max_acceleration)**0.5 # triangular profile
+
+_ROUNDING = { # candidate .dll rounding for nm -> encoder counts
+    'nearest':  lambda x: math.floor(x + 0.5),
+    'truncate': lambda x: int(x),
+    'floor':    lambda x: math.floor(x)}
+
+def list_devices(backend):
+    # serial numbers and ports of the connected MCM301s e.g. ['TP0..', 'COM3']
+    buffer = (10240 * C.c_char)()
+    backend.list_devices(buffer, len(buffer))
+    return buffer.value.decode('ascii').split(',')
+
+_session_lock = threading.Lock() # load, merge and replace one at a time
+
+def _load_session(filename):
+    # all the sessions in a cache file (see 'Controller(session_cache=...)'):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as file:
+        return json.load(file)
+
+def _decode_status(status_bit):
+    # enabled, homed and moving flags from a 'GetMotStatus' status bit:
+    enabled = status_bit & 0x80000000 == 0x80000000
+    homed   = status_bit & 0x00000400 == 0x00000400
+    moving = False
+    for mask in (0x00000010, 0x00000020, 0x00000040, 0x00000080, 0x00000200):
+        if status_bit & mask == mask:
+            moving = True
+    return enabled, homed, moving
+
+class _LockedBackend:
+    # lets several threads (e.g. the status poller) share one backend by
+    # serializing the calls:
+    def __init__(self, backend, lock=None):
+        self.backend = backend
+        self.lock = threading.RLock() if lock is None else lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+        lock = self.lock
+        def call(*args):
+            with lock:
+                return attr(*args)
+        self.__dict__[name] = call # cache the wrapper
+        return call
+
+class _CommandQueue:
+    # one worker thread per handle runs the backend calls in the order they
+    # were queued, except 'stop' which goes ahead of everything queued:
+    def __init__(self, name):
+        self.lock = threading.RLock() # held while a call runs
+        self.queue = queue.PriorityQueue()
+        self._sequence = itertools.count() # FIFO within a priority
+        self.thread = threading.Thread(
+            target=self._run, name='%s commands'%name, daemon=True)
+        self.thread.start()
+
+    def call(self, priority, function, args):
+        future = Future()
+        self.queue.put(
+            (priority, next(self._sequence), function, args, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            priority, sequence, function, args, future = self.queue.get()
+            if function is None: # see 'shutdown'
+                return None
+            with self.lock:
+                try:
+                    future.set_result(function(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def shutdown(self):
+        # finish the queued calls and stop the worker thread:
+        self.queue.put((2, next(self._sequence), None, None, None))
+        self.thread.join()
+        return None
+
+class _QueuedBackend:
+    # thread safe access to one backend through a '_CommandQueue':
+    def __init__(self, backend, commands):
+        self.backend = backend
+        self.commands = commands
+        self.lock = commands.lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+        commands, priority = self.commands, 0 if name == 'stop' else 1
+        def call(*args):
+            return commands.call(priority, attr, args)
+        self.__dict__[name] = call # cache the wrapper
+        return call
+
+_NO_SLOT = ('list_devices', 'open', 'is_open', 'close') # no 'slot' arg
+
+class _MeteredBackend:
+    # counts, errors and latency histograms per (function, slot) for every
+    # backend call (see 'Controller.metrics'), called under the lock:
+    def __init__(self, backend, histograms):
+        self.backend = backend
+        self.histograms = histograms
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+        histograms, has_slot = self.histograms, name not in _NO_SLOT
+        def call(*args):
+            key = (name, args[1] if has_slot else None)
+            t0 = time.perf_counter()
+            try:
+                result = attr(*args)
+            except Exception:
+                _record_latency(histograms, key, time.perf_counter() - t0,
+                                error=True)
+                raise
+            _record_latency(histograms, key, time.perf_counter() - t0)
+            return result
+        self.__dict__[name] = call # cache the wrapper
+        return call
+
+def _record_latency(histograms, key, latency_s, error=False):
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = _LatencyHistogram()
+    histogram.record(latency_s, error)
+    return None
+
+class _LatencyHistogram:
+    # fixed 1-2-5 buckets from 1us to 10s (+ overflow) so recording is O(1):
+    buckets_s = tuple(m * 10**e for e in range(-6, 1) for m in (1, 2, 5)
+                      ) + (10,)
+
+    def __init__(self):
+        self.count, self.errors, self.total_s, self.max_s = 0, 0, 0.0, 0.0
+        self.bucket_counts = (len(self.buckets_s) + 1) * [0]
+
+    def record(self, latency_s, error=False):
+        self.count += 1
+        self.errors += error
+        self.total_s += latency_s
+        if latency_s > self.max_s:
+            self.max_s = latency_s
+        self.bucket_counts[
+            bisect.bisect_left(self.buckets_s, latency_s)] += 1
+        return None
+
+    def copy(self):
+        histogram = _LatencyHistogram()
+        histogram.__dict__.update(self.__dict__)
+        histogram.bucket_counts = list(self.bucket_counts)
+        return histogram
+
+    def quantile(self, q):
+        # upper edge of the bucket holding the q-quantile (capped at max):
+        rank, cumulative = q * self.count, 0
+        for upper_s, count in zip(self.buckets_s, self.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(upper_s, self.max_s)
+        return self.max_s
+
+    def summary(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'total_s': self.total_s,
+                'p50_s': self.quantile(0.50),
+                'p95_s': self.quantile(0.95),
+                'p99_s': self.quantile(0.99),
+                'max_s': self.max_s}
+
+def _prometheus_text(name, histograms):
+    # Prometheus text exposition format (version 0.0.4):
+    metric = 'mcm301_dll_call_seconds'
+    lines = ['# HELP %s Latency of MCM301 .dll calls.'%metric,
+             '# TYPE %s histogram'%metric]
+    errors = ['# HELP mcm301_dll_call_errors_total Failed MCM301 .dll calls.',
+              '# TYPE mcm301_dll_call_errors_total counter']
+    for (function, slot), histogram in sorted(
+        histograms.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+        labels = 'controller="%s",function="%s",slot="%s"'%(
+            name, function, '' if slot is None else slot)
+        cumulative = 0
+        for upper_s, count in zip(histogram.buckets_s,
+                                  histogram.bucket_counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%g"} %i'%(
+                metric, labels, upper_s, cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %i'%(
+            metric, labels, histogram.count))
+        lines.append('%s_sum{%s} %r'%(metric, labels, histogram.total_s))
+        lines.append('%s_count{%s} %i'%(metric, labels, histogram.count))
+        errors.append('mcm301_dll_call_errors_total{%s} %i'%(
+            labels, histogram.errors))
+    return '\n'.join(lines + errors) + '\n'
+
+class _TracedBackend:
+    # records every backend call as a span on the calling thread (see
+    # 'Controller.start_trace'):
+    def __init__(self, backend, tracer):
+        self.backend = backend
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+        tracer, has_slot = self.tracer, name not in _NO_SLOT
+        def call(*args):
+            t0 = time.perf_counter()
+            try:
+                return attr(*args)
+            finally:
+                tracer.complete(name, 'dll', t0, time.perf_counter(),
+                                args={'slot': args[1]} if has_slot else None)
+        self.__dict__[name] = call # cache the wrapper
+        return call
+
+class _Tracer:
+    # bounded ring buffer of Chrome trace events, timestamps from
+    # 'time.perf_counter' in us. Moves go on one track per channel:
+    def __init__(self, name, capacity):
+        self.name = name
+        self.events = collections.deque(maxlen=capacity)
+        self.pid = os.getpid()
+        self.moves = {} # ch -> (name, t_issue, t_issued, args)
+        self.threads = {} # thread id -> name
+
+    def _channel_tid(self, ch):
+        return ch + 1 # small ids never clash with thread idents
+
+    def complete(self, name, cat, t0, t1, tid=None, args=None):
+        if tid is None:
+            thread = threading.current_thread()
+            tid = thread.ident
+            if tid not in self.threads:
+                self.threads[tid] = thread.name
+        event = {'name': name, 'cat': cat, 'ph': 'X',
+                 'ts': 1e6 * t0, 'dur': 1e6 * (t1 - t0),
+                 'pid': self.pid, 'tid': tid}
+        if args is not None:
+            event['args'] = args
+        self.events.append(event) # thread safe
+        return None
+
+    def begin_move(self, ch, name, t_issue, t_issued, args=None):
+        self.moves[ch] = (name, t_issue, t_issued, args)
+        return None
+
+    def end_move(self, ch, t_settled):
+        move = self.moves.pop(ch, None)
+        if move is None: # issued before tracing started
+            return None
+        name, t_issue, t_issued, args = move
+        tid = self._channel_tid(ch)
+        self.complete(name, 'move', t_issue, t_settled, tid, args)
+        self.complete('issue', 'move', t_issue, t_issued, tid)
+        self.complete('moving', 'move', t_issued, t_settled, tid)
+        return None
+
+    def trace(self, channels):
+        # the events with names for the process and tracks:
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                     'args': {'name': self.name}}]
+        threads = dict(self.threads)
+        for ch in channels:
+            threads[self._channel_tid(ch)] = '%s ch%i'%(self.name, ch)
+        for tid, name in threads.items():
+            metadata.append({'name': 'thread_name', 'ph': 'M',
+                             'pid': self.pid, 'tid': tid,
+                             'args': {'name': name}})
+        return {'traceEvents': metadata + list(self.events),
+                'displayTimeUnit': 'ms'}
+
+class RingBufferHandler(logging.Handler):
+    '''
+    'logging.Handler' that keeps the last 'capacity' records in memory
+    (formatting is deferred until 'lines' is called) e.g. for post-mortem
+    debugging via 'Controller.record_log'.
+    '''
+    def __init__(self, capacity=10000):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def lines(self):
+        return [self.format(record) for record in tuple(self.records)]
+
+class StatusStream:
+    '''
+    'GetMotStatus' samples of some channels in a preallocated numpy ring
+    buffer, written by a background thread (see 'Controller.start_stream').
+    Each sample has 't' (time.perf_counter, s), 'ch', 'encoder_count' and
+    'status_bit'. The ctypes arguments are reused and values go straight
+    into the numpy columns, so sampling builds no dicts, lists or ctypes
+    objects. 'snapshot()' copies the buffered samples (oldest first) and
+    iterating yields arrays of new samples until the stream stops.
+    '''
+    def __init__(self, controller, channels, rate_hz=None, capacity=100000):
+        import numpy as np # only needed here, keeps the import fast
+        assert capacity > 0
+        self.controller = controller
+        self.channels = channels
+        self.rate_hz = rate_hz
+        self.capacity = capacity
+        self.samples = np.zeros(capacity, dtype=[('t', 'f8'),
+                                                 ('ch', 'u1'),
+                                                 ('encoder_count', 'i4'),
+                                                 ('status_bit', 'u4')])
+        self.count = 0 # samples written (the next goes to count % capacity)
+        self.dropped = 0 # overwritten before an iterator read them
+        self._new_samples = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name='%s status stream'%controller.name,
+            daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        c = self.controller
+        get_status, hdl = c.dll.get_status, c.hdl
+        targets = [(ch, c.ch_to_slot[ch]) for ch in self.channels]
+        encoder_count, status_bit = C.c_int(), C.c_uint() # reused
+        t, chs, counts, bits = (self.samples[name] for name in # (views)
+                                ('t', 'ch', 'encoder_count', 'status_bit'))
+        capacity, perf_counter = self.capacity, time.perf_counter
+        stop, new_samples = self._stop, self._new_samples
+        period_s = None if self.rate_hz is None else 1 / self.rate_hz
+        i, t_next = 0, perf_counter()
+        while not stop.is_set():
+            for ch, slot in targets:
+                t[i] = perf_counter()
+                get_status(hdl, slot, encoder_count, status_bit)
+                chs[i] = ch
+                counts[i] = encoder_count.value
+                bits[i] = status_bit.value
+                i += 1
+                if i == capacity:
+                    i = 0
+                self.count += 1
+            with new_samples:
+                new_samples.notify_all()
+            if period_s is not None:
+                t_next = max(t_next + period_s, perf_counter())
+                stop.wait(t_next - perf_counter())
+        with new_samples:
+            new_samples.notify_all()
+        return None
 
-os.add_dll_directory(os.getcwd())
-dll = C.cdll.LoadLibrary("MCM301Lib_x64.dll") # needs .dll in directory
+    def snapshot(self, ch=None):
+        '''
+        Copy of the samples in the buffer (of channel 'ch' if given),
+        oldest first.
+        '''
+        import numpy as np
+        count = self.count
+        if count <= self.capacity:
+            samples = self.samples[:count].copy()
+        else:
+            i = count % self.capacity
+            samples = np.concatenate((self.samples[i:], self.samples[:i]))
+        overwritten = self.count - count - (self.capacity - len(samples))
+        if overwritten > 0: # written over (the oldest) while copying
+            samples = samples[overwritten:]
+        if ch is not None:
+            samples = samples[samples['ch'] == ch]
+        return samples
+
+    def __iter__(self):
+        # yields the samples written since the last yield (from the oldest
+        # still in the buffer), counts any lost to a slow reader in 'dropped'
+        import numpy as np
+        read = max(self.count - self.capacity, 0)
+        while True:
+            with self._new_samples:
+                while self.count == read and not self._stop.is_set():
+                    self._new_samples.wait()
+            count = self.count
+            if count == read:
+                return None
+            if count - read > self.capacity:
+                self.dropped += count - read - self.capacity
+                read = count - self.capacity
+            yield self.samples[np.arange(read, count) % self.capacity]
+            read = count
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self in self.controller._streams:
+            self.controller._streams.remove(self)
+            self.controller.logger.info(
+                '%s: stopped status stream (%i samples)',
+                self.controller.name, self.count)
+        return None
+
+### Tidy and store DLL calls away from main program:
 
 def check_error(error_code):
     if error_code != 0:
         raise UserWarning("Thorlabs MCM301 error: %i"%(error_code))
     return error_code
 
-dll.list_devices = dll.List
-dll.list_devices.argtypes = [
-    C.POINTER(C.c_char),        # buffer
-    C.c_int]                    # buffer_length
-dll.list_devices.restype = C.c_int
-
-dll.open = dll.Open
-dll.open.argtypes = [
-    C.POINTER(C.c_char),        # sn
-    C.c_int,                    # nBaud
-    C.c_int]                    # timeout
-dll.open.restype = C.c_int
-
-dll.is_open = dll.IsOpen
-dll.is_open.argtypes = [
-    C.POINTER(C.c_char)]        # sn
-dll.is_open.restype = C.c_int
-
-dll.get_device_type = dll.GetSlotDeviceType
-dll.get_device_type.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.POINTER(C.c_char),        # device_type
-    C.c_int]                    # device_type_length
-dll.get_device_type.restype = check_error
-
 class StageParamStruct(C.Structure):
     _fields_ = [("counts_per_step", C.c_uint),
                 ("nm_per_count",    C.c_float),
@@ -373,96 +2228,281 @@ class StageParamStruct(C.Structure):
                 ("max_speed",       C.c_double),
                 ("max_acceleration",C.c_double)]
 
-dll.get_stage_parameters = dll.GetStageParams
-dll.get_stage_parameters.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.POINTER(StageParamStruct)]# stage_params_info
-dll.get_stage_parameters.restype = check_error
-
-dll.get_home_to_min = dll.GetHomeInfo
-dll.get_home_to_min.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.POINTER(C.c_char)]        # home_direction
-dll.get_home_to_min.restype = check_error
-
-dll.set_home_to_min = dll.SetHomeInfo
-dll.set_home_to_min.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.c_char]                   # home_direction
-dll.set_home_to_min.restype = check_error
-
-dll.get_status = dll.GetMotStatus
-dll.get_status.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.POINTER(C.c_int),         # current_encoder
-    C.POINTER(C.c_uint)]        # status_bit
-dll.get_status.restype = check_error
-
-dll.get_enable = dll.GetChanEnableState
-dll.get_enable.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.POINTER(C.c_char)]        # enable_state
-dll.get_enable.restype = check_error
-
-dll.set_enable = dll.SetChanEnableState
-dll.set_enable.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.c_char]                   # enable_state
-dll.set_enable.restype = check_error
-
-dll.home = dll.Home
-dll.home.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char]                   # slot
-dll.home.restype = check_error
-
-dll.stop = dll.MoveStop
-dll.stop.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char]                   # slot
-dll.stop.restype = check_error
-
-dll.set_velocity = dll.SetVelocity
-dll.set_velocity.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.c_char,                   # direction
-    C.c_char]                   # velocity
-dll.set_velocity.restype = check_error
-
-dll.get_position = dll.ConvertEncoderTonm
-dll.get_position.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.c_int,                    # encoder_count
-    C.POINTER(C.c_double)]      # nm
-dll.get_position.restype = check_error
-
-dll.get_encoder_count = dll.ConvertnmToEncoder
-dll.get_encoder_count.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.c_double,                 # nm
-    C.POINTER(C.c_int)]         # encoder_count
-dll.get_encoder_count.restype = check_error
-
-dll.move = dll.MoveAbsolute
-dll.move.argtypes = [
-    C.c_int,                    # hdl
-    C.c_char,                   # slot
-    C.c_int]                    # encoder_count
-dll.move.restype = check_error
-
-dll.close = dll.Close
-dll.close.argtypes = [
-    C.c_int]                    # hdl
-dll.close.restype = check_error
+class Backend(abc.ABC):
+    '''
+    Interface for the calls the 'Controller' makes to the MCM301. Method
+    names and signatures follow the renamed .dll functions (e.g.
+    'get_status' -> 'GetMotStatus'), including the ctypes output arguments
+    that are filled in place. See 'DLLBackend' for the real hardware and
+    'thorlabs_MCM301_sim.SimulatedMCM301' for an in-process simulation.
+    Every method is abstract so an incomplete backend (e.g. a recorded
+    replay) fails when it is created rather than on its first missing call.
+    '''
+    @abc.abstractmethod
+    def list_devices(self, buffer, buffer_length):
+        raise NotImplementedError # -> List
+
+    @abc.abstractmethod
+    def open(self, sn, nBaud, timeout):
+        raise NotImplementedError # -> Open
+
+    @abc.abstractmethod
+    def is_open(self, sn):
+        raise NotImplementedError # -> IsOpen
+
+    @abc.abstractmethod
+    def get_device_type(self, hdl, slot, device_type, device_type_length):
+        raise NotImplementedError # -> GetSlotDeviceType
+
+    @abc.abstractmethod
+    def get_stage_parameters(self, hdl, slot, stage_params_info):
+        raise NotImplementedError # -> GetStageParams
+
+    @abc.abstractmethod
+    def get_home_to_min(self, hdl, slot, home_direction):
+        raise NotImplementedError # -> GetHomeInfo
+
+    @abc.abstractmethod
+    def set_home_to_min(self, hdl, slot, home_direction):
+        raise NotImplementedError # -> SetHomeInfo
+
+    @abc.abstractmethod
+    def get_status(self, hdl, slot, current_encoder, status_bit):
+        raise NotImplementedError # -> GetMotStatus
+
+    @abc.abstractmethod
+    def get_enable(self, hdl, slot, enable_state):
+        raise NotImplementedError # -> GetChanEnableState
+
+    @abc.abstractmethod
+    def set_enable(self, hdl, slot, enable_state):
+        raise NotImplementedError # -> SetChanEnableState
+
+    @abc.abstractmethod
+    def home(self, hdl, slot):
+        raise NotImplementedError # -> Home
+
+    @abc.abstractmethod
+    def stop(self, hdl, slot):
+        raise NotImplementedError # -> MoveStop
+
+    @abc.abstractmethod
+    def set_velocity(self, hdl, slot, direction, velocity):
+        raise NotImplementedError # -> SetVelocity
+
+    @abc.abstractmethod
+    def get_position(self, hdl, slot, encoder_count, nm):
+        raise NotImplementedError # -> ConvertEncoderTonm
+
+    @abc.abstractmethod
+    def get_encoder_count(self, hdl, slot, nm, encoder_count):
+        raise NotImplementedError # -> ConvertnmToEncoder
+
+    @abc.abstractmethod
+    def move(self, hdl, slot, encoder_count):
+        raise NotImplementedError # -> MoveAbsolute
+
+    @abc.abstractmethod
+    def set_jog_params(self, hdl, slot, step_size):
+        raise NotImplementedError # -> SetJogParams
+
+    @abc.abstractmethod
+    def get_jog_params(self, hdl, slot, jog_step_size):
+        raise NotImplementedError # -> GetJogParams
+
+    @abc.abstractmethod
+    def save_jog_params(self, hdl, slot):
+        raise NotImplementedError # -> SetEEPROMPARAMSJogParams
+
+    @abc.abstractmethod
+    def move_jog(self, hdl, slot, direction):
+        raise NotImplementedError # -> MoveJog
+
+    @abc.abstractmethod
+    def close(self, hdl):
+        raise NotImplementedError # -> Close
+
+DLL_NAME = "MCM301Lib_x64.dll"
+_dll_backends = {} # loaded .dll's with bound prototypes, keyed by path
+
+def load_dll(dll_path=None, search_path=None):
+    '''
+    Return the 'DLLBackend' for the .dll, loading it and binding the
+    prototypes on the first call only. Pass an explicit 'dll_path' or a
+    'search_path' list of folders to look in (default: the folder of this
+    module, then the current working directory).
+    '''
+    if dll_path is None:
+        if search_path is None:
+            search_path = (os.path.dirname(os.path.abspath(__file__)),
+                           os.getcwd())
+        for folder in search_path:
+            if os.path.isfile(os.path.join(folder, DLL_NAME)):
+                dll_path = os.path.join(folder, DLL_NAME)
+                break
+        else:
+            raise FileNotFoundError(
+                "%s not found in search path %s"%(DLL_NAME, search_path))
+    dll_path = os.path.abspath(dll_path)
+    if dll_path not in _dll_backends:
+        _dll_backends[dll_path] = DLLBackend(dll_path)
+    return _dll_backends[dll_path]
+
+@Backend.register # (the .dll functions are bound per instance)
+class DLLBackend:
+    '''
+    Calls the Thorlabs "MCM301Lib_x64.dll" via ctypes (Windows only). Use
+    'load_dll' to get a cached instance rather than binding it again.
+    '''
+    def __init__(self, dll_path):
+        if hasattr(os, 'add_dll_directory'): # finds .dll dependencies
+            os.add_dll_directory(os.path.dirname(dll_path))
+        dll = C.cdll.LoadLibrary(dll_path)
+        self.lib = dll
+
+        self.list_devices = dll.List
+        self.list_devices.argtypes = [
+            C.POINTER(C.c_char),        # buffer
+            C.c_int]                    # buffer_length
+        self.list_devices.restype = C.c_int
+
+        self.open = dll.Open
+        self.open.argtypes = [
+            C.POINTER(C.c_char),        # sn
+            C.c_int,                    # nBaud
+            C.c_int]                    # timeout
+        self.open.restype = C.c_int
+
+        self.is_open = dll.IsOpen
+        self.is_open.argtypes = [
+            C.POINTER(C.c_char)]        # sn
+        self.is_open.restype = C.c_int
+
+        self.get_device_type = dll.GetSlotDeviceType
+        self.get_device_type.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.POINTER(C.c_char),        # device_type
+            C.c_int]                    # device_type_length
+        self.get_device_type.restype = check_error
+
+        self.get_stage_parameters = dll.GetStageParams
+        self.get_stage_parameters.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.POINTER(StageParamStruct)]# stage_params_info
+        self.get_stage_parameters.restype = check_error
+
+        self.get_home_to_min = dll.GetHomeInfo
+        self.get_home_to_min.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.POINTER(C.c_char)]        # home_direction
+        self.get_home_to_min.restype = check_error
+
+        self.set_home_to_min = dll.SetHomeInfo
+        self.set_home_to_min.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_char]                   # home_direction
+        self.set_home_to_min.restype = check_error
+
+        self.get_status = dll.GetMotStatus
+        self.get_status.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.POINTER(C.c_int),         # current_encoder
+            C.POINTER(C.c_uint)]        # status_bit
+        self.get_status.restype = check_error
+
+        self.get_enable = dll.GetChanEnableState
+        self.get_enable.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.POINTER(C.c_char)]        # enable_state
+        self.get_enable.restype = check_error
+
+        self.set_enable = dll.SetChanEnableState
+        self.set_enable.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_char]                   # enable_state
+        self.set_enable.restype = check_error
+
+        self.home = dll.Home
+        self.home.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char]                   # slot
+        self.home.restype = check_error
+
+        self.stop = dll.MoveStop
+        self.stop.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char]                   # slot
+        self.stop.restype = check_error
+
+        self.set_velocity = dll.SetVelocity
+        self.set_velocity.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_char,                   # direction
+            C.c_char]                   # velocity
+        self.set_velocity.restype = check_error
+
+        self.get_position = dll.ConvertEncoderTonm
+        self.get_position.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_int,                    # encoder_count
+            C.POINTER(C.c_double)]      # nm
+        self.get_position.restype = check_error
+
+        self.get_encoder_count = dll.ConvertnmToEncoder
+        self.get_encoder_count.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_double,                 # nm
+            C.POINTER(C.c_int)]         # encoder_count
+        self.get_encoder_count.restype = check_error
+
+        self.move = dll.MoveAbsolute
+        self.move.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_int]                    # encoder_count
+        self.move.restype = check_error
+
+        self.set_jog_params = dll.SetJogParams
+        self.set_jog_params.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_uint]                   # step_size
+        self.set_jog_params.restype = check_error
+
+        self.get_jog_params = dll.GetJogParams
+        self.get_jog_params.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.POINTER(C.c_uint)]        # jog_step_size
+        self.get_jog_params.restype = check_error
+
+        self.save_jog_params = dll.SetEEPROMPARAMSJogParams
+        self.save_jog_params.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char]                   # slot
+        self.save_jog_params.restype = check_error
+
+        self.move_jog = dll.MoveJog
+        self.move_jog.argtypes = [
+            C.c_int,                    # hdl
+            C.c_char,                   # slot
+            C.c_char]                   # direction
+        self.move_jog.restype = check_error
+
+        self.close = dll.Close
+        self.close.argtypes = [
+            C.c_int]                    # hdl
+        self.close.restype = check_error
 
 if __name__ == '__main__':
     controller = Controller(sn='TP03522143-695014',
@@ -0,0 +1,442 @@
+# Imports from the python standard library:
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+def benchmark_import(repeats=10):
+    '''
+    Time 'import thorlabs_MCM301' in a fresh interpreter (python -X
+    importtime) and check that the .dll was not loaded as a side effect.
+    Returns the best cumulative import time in seconds.
+    '''
+    code = ('import thorlabs_MCM301; '
+            'assert not thorlabs_MCM301._dll_backends, ".dll loaded"')
+    folder = os.path.dirname(os.path.abspath(__file__))
+    times_s = []
+    for i in range(repeats):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=folder, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        for line in result.stderr.splitlines(): # 'self | cumulative | name'
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'thorlabs_MCM301':
+                times_s.append(1e-6 * int(fields[1]))
+    return min(times_s)
+
+def benchmark_logging(calls=20000):
+    '''
+    Time '_get_status' (the hot path of every wait) on a zero latency
+    simulator with the controller logger at WARNING, INFO and DEBUG (to an
+    in-memory stream) and with DEBUG kept only in a ring buffer. Returns
+    the mean time per call in seconds for each case.
+    '''
+    from thorlabs_MCM301 import Controller
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    stages = ('MPM-000001', None, None)
+    results = {}
+    for case in ('WARNING', 'INFO', 'DEBUG', 'DEBUG (ring buffer)'):
+        controller = Controller(sn='TP00000000-000000',
+                                stages=stages,
+                                min_mm=(0, None, None),
+                                max_mm=(10, None, None),
+                                name='benchmark',
+                                backend=SimulatedMCM301(
+                                    stages=stages, homed=True, enabled=True),
+                                verbose=False)
+        logger = controller.logger
+        stream = logging.StreamHandler(io.StringIO())
+        stream.setLevel(logging.INFO if case == 'INFO' else logging.DEBUG)
+        logger.addHandler(stream)
+        if case == 'DEBUG (ring buffer)':
+            stream.setLevel(logging.WARNING)
+            logger.setLevel(logging.WARNING)
+            controller.record_log(capacity=1000)
+        else:
+            logger.setLevel(getattr(logging, case))
+        t0 = time.perf_counter()
+        for i in range(calls):
+            controller._get_status(0)
+        results[case] = (time.perf_counter() - t0) / calls
+        controller.close()
+        logger.handlers.clear()
+        logger.setLevel(logging.NOTSET) # back to the application's level
+    return results
+
+def benchmark_metrics(calls=20000):
+    '''
+    Time '_get_status' on a zero latency simulator with the .dll call
+    metrics disabled and enabled. Returns the mean time per call in seconds
+    for each case.
+    '''
+    from thorlabs_MCM301 import Controller
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    stages = ('MPM-000001', None, None)
+    controller = Controller(sn='TP00000000-000000',
+                            stages=stages,
+                            min_mm=(0, None, None),
+                            max_mm=(10, None, None),
+                            name='benchmark',
+                            backend=SimulatedMCM301(
+                                stages=stages, homed=True, enabled=True),
+                            verbose=False)
+    results = {}
+    for enabled in (False, True):
+        controller.enable_metrics(enabled)
+        t0 = time.perf_counter()
+        for i in range(calls):
+            controller._get_status(0)
+        results[enabled] = (time.perf_counter() - t0) / calls
+    controller.close()
+    return results
+
+def _simulated_controller(latency_s=1e-3, stages=3*('MPM-000001',)):
+    # controller on a simulator with fast stages so moves take ~10-100ms:
+    from thorlabs_MCM301 import Controller
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    return Controller(sn='TP00000000-000000',
+                      stages=stages,
+                      min_mm=3*(0,),
+                      max_mm=3*(10,),
+                      name='benchmark',
+                      backend=SimulatedMCM301(
+                          stages=stages,
+                          stage_parameters={'max_speed': 50,
+                                            'max_acceleration': 500},
+                          latency_s=latency_s,
+                          initial_counts=3*(2000,)),
+                      verbose=False)
+
+def benchmark_session_cache(latency_s=1e-3, repeats=5):
+    '''
+    Time 'Controller.__init__' on an already homed and enabled simulator
+    without ('cold_s') and with ('warm_s') a session cache. Returns the
+    best times in seconds and the number of .dll calls for each.
+    '''
+    from thorlabs_MCM301 import Controller
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    stages = 3*('MPM-000001',)
+    simulator = SimulatedMCM301(
+        stages=stages, latency_s=latency_s, homed=True, enabled=True)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        session_cache = os.path.join(folder, 'session.json')
+        for case in ('cold', 'warm'):
+            times_s = []
+            for i in range(repeats):
+                simulator.calls.clear()
+                t0 = time.perf_counter()
+                controller = Controller(
+                    sn='TP00000000-000000',
+                    stages=stages,
+                    min_mm=3*(0,),
+                    max_mm=3*(10,),
+                    name='benchmark',
+                    backend=simulator,
+                    session_cache=None if case == 'cold' else session_cache,
+                    verbose=False)
+                times_s.append(time.perf_counter() - t0)
+                calls = sum(simulator.calls.values())
+                controller.close()
+                if case == 'warm' and i == 0: # first run fills the cache
+                    times_s.pop()
+            results[case + '_s'] = min(times_s)
+            results[case + '_calls'] = calls
+    return results
+
+def benchmark_pool(n_controllers=4, latency_s=1e-3):
+    '''
+    Time bringing up one simulated controller and a 'ControllerPool' of
+    'n_controllers' (homing included). Returns the times in seconds.
+    '''
+    from thorlabs_MCM301 import Controller, ControllerPool
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    stages = 3*('MPM-000001',)
+    def controller_kwargs(i):
+        sn = 'TP%08i-000000'%i
+        return dict(sn=sn,
+                    stages=stages,
+                    min_mm=3*(0,),
+                    max_mm=3*(10,),
+                    backend=SimulatedMCM301(
+                        sn=sn,
+                        stages=stages,
+                        stage_parameters={'max_speed': 50,
+                                          'max_acceleration': 500},
+                        latency_s=latency_s),
+                    verbose=False)
+    t0 = time.perf_counter()
+    Controller(**controller_kwargs(0)).close()
+    one_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    pool = ControllerPool(
+        {'mcm%i'%i: controller_kwargs(i) for i in range(n_controllers)},
+        devices=['TP%08i-000000'%i for i in range(n_controllers)])
+    pool_s = time.perf_counter() - t0
+    pool.close()
+    return {'one_s': one_s, 'pool_s': pool_s}
+
+def benchmark_stop_latency(thread_safe, readers=4, repeats=20,
+                           latency_s=1e-3):
+    '''
+    Time from 'Controller.stop' to the 'MoveStop' reaching the simulator
+    while the stage moves under heavy polling: a 'busy' wait, the status
+    poller at 1kHz and 'readers' threads reading the status back to back.
+    Returns the median and max latency in seconds.
+    '''
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    stop_times = []
+    class Simulator(SimulatedMCM301):
+        def stop(self, hdl, slot):
+            stop_times.append(time.perf_counter())
+            return super().stop(hdl, slot)
+    stages = 3*('MPM-000001',)
+    from thorlabs_MCM301 import Controller
+    controller = Controller(sn='TP00000000-000000',
+                            stages=stages,
+                            min_mm=3*(0,),
+                            max_mm=3*(10,),
+                            name='benchmark',
+                            backend=Simulator(stages=stages,
+                                              latency_s=latency_s,
+                                              homed=True,
+                                              enabled=True),
+                            thread_safe=thread_safe,
+                            verbose=False)
+    controller.start_poller(rate_hz=1000)
+    done = threading.Event()
+    def read_status():
+        while not done.is_set():
+            controller.get_state(1, max_age=0)
+    threads = [threading.Thread(target=read_status) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    latencies_s = []
+    for i in range(repeats):
+        controller.move_mm(0, 9 if i % 2 == 0 else 1, relative=False,
+                           block=False)
+        waiter = threading.Thread(target=controller.finish_moving_many,
+                                  args=((0,),), kwargs={'strategy': 'busy'})
+        waiter.start()
+        time.sleep(0.02)
+        t0 = time.perf_counter()
+        controller.stop(0)
+        latencies_s.append(stop_times[-1] - t0)
+        waiter.join()
+    done.set()
+    for thread in threads:
+        thread.join()
+    controller.close()
+    latencies_s.sort()
+    return {'median_s': latencies_s[len(latencies_s) // 2],
+            'max_s': latencies_s[-1]}
+
+def benchmark_watchdog(latency_s=1e-3, repeats=5):
+    '''
+    Time to detect a stage that stops mid move while still reporting
+    moving ('SimulatedMCM301.obstruct'): from the obstruction to the
+    'MoveTimeoutError' ('stall_s' plus up to one poll), and for a stage
+    slower than the calibrated motion model ('deadline', 'watchdog_scale'
+    set to 1.5 and 'watchdog_margin_s' to 0.1). Returns the median times in
+    seconds.
+    '''
+    from thorlabs_MCM301 import MoveTimeoutError
+    controller = _simulated_controller(latency_s)
+    backend = controller._backend
+    stall_s, deadline_s = [], []
+    for i in range(repeats):
+        controller.move_mm(0, 9 if i % 2 == 0 else 1, relative=False,
+                           block=False)
+        time.sleep(0.05)
+        backend.obstruct(4)
+        t0 = time.perf_counter()
+        try:
+            controller.finish_moving_many((0,))
+        except MoveTimeoutError:
+            stall_s.append(time.perf_counter() - t0)
+        backend.obstruct(4, False)
+    controller.calibrate_motion_model(0) # (arms the deadline)
+    controller.watchdog_scale, controller.watchdog_margin_s = 1.5, 0.1
+    parameters = backend._slots[4]['parameters']
+    parameters.max_speed /= 4 # the stage is slower than the controller thinks
+    for i in range(repeats):
+        controller.move_mm(0, 9 if i % 2 == 0 else 1, relative=False,
+                           block=False)
+        try:
+            controller.finish_moving_many((0,))
+        except MoveTimeoutError as e:
+            deadline_s.append(e.detect_s)
+    parameters.max_speed *= 4
+    controller.close()
+    stall_s.sort()
+    deadline_s.sort()
+    return {'stall_s': stall_s[len(stall_s) // 2],
+            'deadline_s': deadline_s[len(deadline_s) // 2]}
+
+def benchmark_stream(duration_s=0.5, latency_s=0):
+    '''
+    Status samples/s of one channel from 'Controller.start_stream' (numpy
+    ring buffer) and from a loop of '_read_status' (a dict per sample).
+    With the default 'latency_s=0' this is the Python overhead per sample.
+    '''
+    controller = _simulated_controller(latency_s)
+    results = {}
+    stream = controller.start_stream((0,))
+    t0 = time.perf_counter()
+    time.sleep(duration_s)
+    stream.stop()
+    results['stream_per_s'] = stream.count / (time.perf_counter() - t0)
+    samples, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < duration_s:
+        controller._read_status(0)
+        samples += 1
+    results['read_status_per_s'] = samples / (time.perf_counter() - t0)
+    controller.close()
+    return results
+
+def benchmark_suite(latency_s=1e-3, repeats=20):
+    '''
+    Time the hot paths on a simulator with 'latency_s' per call (best of
+    'repeats' unless stated, after 'calibrate_motion_model'). Returns a dict of results in seconds or per
+    second ('_per_s'):
+    - 'import_s': 'import thorlabs_MCM301' (see 'benchmark_import')
+    - 'init_s': 'Controller.__init__' with three stages (homing included)
+    - 'init_warm_s': 'Controller.__init__' from a session cache
+    - 'move_issue_s': 'move_mm(..., block=False)'
+    - 'status_polls_per_s': status polls during a 'busy' wait
+    - 'get_position_s': 'get_position_mm(ch, max_age=0)' (status read)
+    - 'move_3_axes_s': 'move_mm_many' of 1mm on three axes (wall time)
+    - 'scan_points_per_s': 'Scan.run' of a 5x5x5 grid (no callback)
+    - 'step_moves_per_s': 1um relative 'move_mm' steps (blocking)
+    - 'jog_steps_per_s': 1um 'jog' steps (blocking, see 'jog_stats')
+    '''
+    from thorlabs_MCM301_scan import Scan, grid_scan
+    results = {'import_s': benchmark_import()}
+    times_s = []
+    for i in range(max(repeats // 4, 1)): # homing makes this slow
+        t0 = time.perf_counter()
+        controller = _simulated_controller(latency_s)
+        times_s.append(time.perf_counter() - t0)
+        controller.close()
+    results['init_s'] = min(times_s)
+    results['init_warm_s'] = benchmark_session_cache(latency_s)['warm_s']
+    controller = _simulated_controller(latency_s)
+    for ch in controller.channels: # the 'model' waits need a calibration
+        controller.calibrate_motion_model(ch)
+    times_s = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        controller.move_mm(0, 0.01 if i % 2 == 0 else -0.01, block=False)
+        times_s.append(time.perf_counter() - t0)
+        controller.finish_moving_many((0,))
+    results['move_issue_s'] = min(times_s)
+    controller.move_mm(0, 5, relative=False, block=False)
+    controller.finish_moving_many((0,), strategy='busy')
+    stats = controller.wait_stats[0]
+    results['status_polls_per_s'] = stats['status_calls'] / stats['wall_s']
+    times_s = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        controller.get_position_mm(1, max_age=0)
+        times_s.append(time.perf_counter() - t0)
+    results['get_position_s'] = min(times_s)
+    times_s = []
+    for i in range(max(repeats // 4, 1)):
+        t0 = time.perf_counter()
+        controller.move_mm_many(
+            {ch: 1 if i % 2 == 0 else -1 for ch in controller.channels},
+            relative=True)
+        times_s.append(time.perf_counter() - t0)
+    results['move_3_axes_s'] = min(times_s)
+    channels, positions_mm = grid_scan(
+        controller, {ch: (1, 1.2, 0.05) for ch in controller.channels})
+    result = Scan(controller, channels).run(positions_mm)
+    results['scan_points_per_s'] = result['points_per_s']
+    t0 = time.perf_counter()
+    for i in range(5 * repeats):
+        controller.move_mm(0, 0.001)
+    results['step_moves_per_s'] = 5 * repeats / (time.perf_counter() - t0)
+    controller.set_jog_step_mm(0, 0.001)
+    controller.jog(0, 5 * repeats)
+    results['jog_steps_per_s'] = controller.jog_stats[0]['steps_per_s']
+    controller.close()
+    return results
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Compare 'results' to a saved 'baseline' (both from 'benchmark_suite').
+    Returns {name: (baseline, result, change)} for the results more than
+    'tolerance' (fraction) worse: slower times or fewer '_per_s'.
+    '''
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result / baseline[name] - 1
+        if name.endswith('_per_s'): # higher is better
+            change = -change
+        if change > tolerance:
+            regressions[name] = (baseline[name], result, change)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark thorlabs_MCM301 on the simulated backend')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare to these saved results')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed fractional regression (default 0.1)')
+    parser.add_argument('--latency', type=float, default=1e-3,
+                        help='simulated latency per call (s)')
+    args = parser.parse_args()
+    results = benchmark_suite(latency_s=args.latency)
+    for name, result in results.items():
+        print('%s: %0.6g'%(name, result))
+    for case, time_s in benchmark_logging().items():
+        print('_get_status, log level %s: %0.2fus'%(case, 1e6 * time_s))
+    for enabled, time_s in benchmark_metrics().items():
+        print('_get_status, metrics=%s: %0.2fus'%(enabled, 1e6 * time_s))
+    pool = benchmark_pool(latency_s=args.latency)
+    print('Controller: %0.1fms, ControllerPool of 4: %0.1fms'%(
+        1e3 * pool['one_s'], 1e3 * pool['pool_s']))
+    for thread_safe in (False, True):
+        stop = benchmark_stop_latency(thread_safe, latency_s=args.latency)
+        print('stop latency under load, thread_safe=%s: '
+              'median %0.2fms, max %0.2fms'%(
+                  thread_safe, 1e3 * stop['median_s'], 1e3 * stop['max_s']))
+    stream = benchmark_stream()
+    print('status samples/s: stream %0.0f, _read_status loop %0.0f'%(
+        stream['stream_per_s'], stream['read_status_per_s']))
+    watchdog = benchmark_watchdog(latency_s=args.latency)
+    print('watchdog time to detect, stall: %0.1fms, deadline: %0.1fms'%(
+        1e3 * watchdog['stall_s'], 1e3 * watchdog['deadline_s']))
+    session = benchmark_session_cache(latency_s=args.latency)
+    print('Controller.__init__ cold: %0.1fms (%i calls), '
+          'warm: %0.1fms (%i calls)'%(
+              1e3 * session['cold_s'], session['cold_calls'],
+              1e3 * session['warm_s'], session['warm_calls']))
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump({'python': platform.python_version(),
+                       'latency_s': args.latency,
+                       'results': results}, file, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        assert baseline['latency_s'] == args.latency, (
+            'baseline was measured with latency %ss'%baseline['latency_s'])
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for name, (before, after, change) in regressions.items():
+            print('REGRESSION %s: %0.6g -> %0.6g (%+0.0f%%)'%(
+                name, before, after, 100 * change))
+        if regressions:
+            sys.exit(1)
+        print('no regressions vs %s'%args.baseline)
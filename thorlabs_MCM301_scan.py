@@ -0,0 +1,313 @@
+# Imports from the python standard library:
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports, installable via pip:
+import numpy as np
+
+class Scan:
+    '''
+    Drives a 'Controller' through an (N, n_channels) array of absolute
+    positions (mm) with the minimum dead time between points: each point is
+    a 'move_mm_many' (only the channels that change) and one combined wait,
+    after which 'callback(index, position_mm)' is called (e.g. to trigger a
+    camera).
+
+    With 'overlap=True' the callback runs on a worker thread and the next
+    move starts as soon as the callback returns or calls 'Scan.release()'
+    (e.g. once the exposure ends), so readout can overlap with the move.
+    With 'tolerance_counts' a point is settled once every encoder is within
+    that many counts of its target (see 'Controller.finish_moving_many').
+    '''
+    def __init__(self, controller, channels=None, tolerance_counts=None):
+        if channels is None: channels = controller.channels
+        for ch in channels:
+            assert ch in controller.channels, (
+                "%s: channel (%s) not available"%(controller.name, ch))
+        self.controller = controller
+        self.channels = tuple(channels)
+        self.tolerance_counts = tolerance_counts
+        self._released = threading.Event()
+
+    def release(self):
+        # called from the callback: safe to start the next move
+        self._released.set()
+        return None
+
+    def run(self, positions_mm, callback=None, overlap=False):
+        '''
+        Returns a dict with the achieved 'points_per_s', 'total_s' and per
+        point arrays 't_settled_s' (since the start), 'position_mm' (the
+        encoder verified positions when settled, one column per channel),
+        'move_s' (issuing the move), 'settle_s' (waiting for the stage) and
+        'callback_s'.
+        '''
+        c = self.controller
+        positions_mm = np.asarray(positions_mm, dtype='float64')
+        assert positions_mm.ndim == 2, 'positions_mm must be (N, n_channels)'
+        assert positions_mm.shape[1] == len(self.channels), (
+            'positions_mm must have one column per channel %s'%(
+                self.channels,))
+        for i, ch in enumerate(self.channels): # check limits up front
+            assert c.min_mm[ch] <= positions_mm[:, i].min(), (
+                "%s(ch%s): scan goes below min_mm"%(c.name, ch))
+            assert positions_mm[:, i].max() <= c.max_mm[ch], (
+                "%s(ch%s): scan goes above max_mm"%(c.name, ch))
+        n = positions_mm.shape[0]
+        t_settled_s, move_s, settle_s, callback_s = (
+            np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n))
+        counts = np.zeros((n, len(self.channels)), dtype='int64')
+        executor = ThreadPoolExecutor(max_workers=1) if overlap else None
+        pending = None # (index, future) of an overlapping callback
+        t0 = time.perf_counter()
+        try:
+            for i in range(n):
+                t_move = time.perf_counter()
+                targets_mm = {}
+                for ch, position_mm in zip(self.channels, positions_mm[i]):
+                    if position_mm != c._target_mm[ch]:
+                        targets_mm[ch] = float(position_mm)
+                c.move_mm_many(targets_mm, relative=False, block=False)
+                t_settle = time.perf_counter()
+                c.finish_moving_many(
+                    tuple(targets_mm), tolerance_counts=self.tolerance_counts)
+                t_settled = time.perf_counter()
+                counts[i] = [c._encoder_count[ch] for ch in self.channels]
+                move_s[i] = t_settle - t_move
+                settle_s[i] = t_settled - t_settle
+                t_settled_s[i] = t_settled - t0
+                if pending is not None: # callback ran during the move
+                    j, future = pending
+                    callback_s[j] = future.result()
+                    pending = None
+                if callback is None:
+                    continue
+                if overlap:
+                    released = threading.Event() # one per point
+                    self._released = released
+                    future = executor.submit(
+                        self._timed_callback, callback, i, positions_mm[i])
+                    future.add_done_callback(lambda f: released.set())
+                    pending = (i, future)
+                    released.wait()
+                else:
+                    callback_s[i] = self._timed_callback(
+                        callback, i, positions_mm[i])
+            if pending is not None:
+                j, future = pending
+                callback_s[j] = future.result()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        total_s = time.perf_counter() - t0
+        position_mm = np.zeros(counts.shape)
+        for i, ch in enumerate(self.channels):
+            position_mm[:, i] = c.counts_to_mm(ch, counts[:, i])
+        return {'points_per_s': n / total_s,
+                'total_s': total_s,
+                't_settled_s': t_settled_s,
+                'position_mm': position_mm,
+                'move_s': move_s,
+                'settle_s': settle_s,
+                'callback_s': callback_s}
+
+    def _timed_callback(self, callback, index, position_mm):
+        t = time.perf_counter()
+        callback(index, position_mm)
+        return time.perf_counter() - t
+
+class ZStack(Scan):
+    '''
+    Focus stack on one channel: 'run(start_mm, stop_mm, step_mm, acquire)'
+    moves through the slices, waits for each to settle (within
+    'tolerance_counts' of the target if given) and calls 'acquire(index,
+    z_mm)'. With 'overlap=True' the next move starts when 'acquire' calls
+    'ZStack.release()' (e.g. once the exposure ends) instead of after the
+    readout.
+    '''
+    def __init__(self, controller, ch, tolerance_counts=None):
+        super().__init__(controller, (ch,), tolerance_counts)
+        self.ch = ch
+
+    def run(self, start_mm, stop_mm, step_mm, acquire=None, overlap=False):
+        '''
+        'start_mm' and 'stop_mm' must be within the channel's limits.
+        Returns a dict with per slice arrays 'z_mm' (commanded),
+        'position_mm' (encoder verified), 'error_mm' (position - z),
+        't_settled_s' (since the start), 'settle_s' and 'acquire_s', and the
+        throughput: 'slices_per_s', 'total_s' and the mean 'settle_ms' and
+        'acquire_ms'.
+        '''
+        ch, c = self.ch, self.controller
+        for z in (start_mm, stop_mm): # (grid_scan drops slices out of range)
+            assert c.min_mm[ch] <= z <= c.max_mm[ch], (
+                "%s(ch%s): z-stack goes outside min_mm/max_mm"%(c.name, ch))
+        z_mm = grid_scan(c, {ch: (start_mm, stop_mm, step_mm)},
+                         order='raster')[1]
+        result = super().run(z_mm, acquire, overlap)
+        z_mm, position_mm = z_mm[:, 0], result['position_mm'][:, 0]
+        return {'z_mm': z_mm,
+                'position_mm': position_mm,
+                'error_mm': position_mm - z_mm,
+                't_settled_s': result['t_settled_s'],
+                'settle_s': result['settle_s'],
+                'acquire_s': result['callback_s'],
+                'slices_per_s': result['points_per_s'],
+                'total_s': result['total_s'],
+                'settle_ms': 1e3 * result['settle_s'].mean(),
+                'acquire_ms': 1e3 * result['callback_s'].mean()}
+
+def grid_scan(controller, axes_mm, order='serpentine'):
+    '''
+    Positions for a 2D/3D grid scan. 'axes_mm' maps channels to
+    (start_mm, stop_mm, step_mm) ranges (stop included) listed from the
+    slowest to the fastest axis e.g. {0: (0, 5, 1), 1: (0, 5, 1), 2: (0,
+    0.1, 0.01)} for x/y tiles with a z-stack per tile. Values outside a
+    channel's 'min_mm'/'max_mm' are dropped. 'order' is:
+    - 'raster': row-major, the fast axes fly back at the end of each line
+    - 'serpentine': boustrophedon, each axis reverses instead of flying back
+    - 'fastest': the serpentine axis order with the lowest total move time
+      predicted from each axis' max_speed/max_acceleration
+    Returns (channels, positions_mm) for 'Scan(controller, channels).run'.
+    '''
+    assert order in ('raster', 'serpentine', 'fastest')
+    channels, values_mm = tuple(axes_mm), []
+    for ch, (start_mm, stop_mm, step_mm) in axes_mm.items():
+        assert ch in controller.channels, (
+            "%s: channel (%s) not available"%(controller.name, ch))
+        assert step_mm != 0 and (stop_mm - start_mm) / step_mm >= 0, (
+            "%s(ch%s): step_mm does not go from start_mm to stop_mm"%(
+                controller.name, ch))
+        n = int(np.floor((stop_mm - start_mm) / step_mm + 1e-9)) + 1
+        values = start_mm + step_mm * np.arange(n)
+        values = values[(controller.min_mm[ch] <= values) &
+                        (values <= controller.max_mm[ch])]
+        assert len(values) > 0, (
+            "%s(ch%s): no scan positions within limits"%(controller.name, ch))
+        values_mm.append(values)
+    if order == 'raster':
+        grid = np.meshgrid(*values_mm, indexing='ij')
+        return channels, np.stack(grid, axis=-1).reshape(-1, len(channels))
+    if order == 'serpentine':
+        return channels, _serpentine(values_mm)
+    best_time_s, best_positions_mm = None, None
+    for axis_order in itertools.permutations(range(len(channels))):
+        positions_mm = _serpentine([values_mm[i] for i in axis_order])[
+            :, np.argsort(axis_order)] # back to the 'channels' columns
+        time_s = _predict_move_times_s(
+            controller, channels, positions_mm).sum()
+        if best_time_s is None or time_s < best_time_s:
+            best_time_s, best_positions_mm = time_s, positions_mm
+    return channels, best_positions_mm
+
+def _serpentine(values_mm):
+    # boustrophedon grid: the faster axes reverse on alternate rows so
+    # consecutive points differ in one axis only
+    if len(values_mm) == 1:
+        return values_mm[0].reshape(-1, 1)
+    inner = _serpentine(values_mm[1:])
+    blocks = []
+    for i, value in enumerate(values_mm[0]):
+        block = inner if i % 2 == 0 else inner[::-1]
+        blocks.append(np.column_stack((np.full(len(block), value), block)))
+    return np.concatenate(blocks)
+
+def plan_scan(controller, channels, positions_mm, start_mm=None,
+              overhead_s=0):
+    '''
+    Predict how long a trajectory of (N, n_channels) absolute positions
+    will take before running it, vectorized so a 100k point plan takes
+    milliseconds. Each move lasts as long as its slowest ('critical') axis
+    according to 'Controller.estimate_move_time' (including any
+    calibration), plus 'overhead_s' per point (e.g. the callback).
+    'start_mm' is the starting position per channel (default: the
+    controller's current targets).
+    Returns a dict with 'total_s', per move arrays 'move_s' and
+    'critical_channel', and 'critical_s' (time each channel is critical).
+    '''
+    positions_mm = np.asarray(positions_mm, dtype='float64')
+    assert positions_mm.ndim == 2 and positions_mm.shape[1] == len(channels)
+    if start_mm is None:
+        start_mm = [controller._get_target_mm(ch) for ch in channels]
+    positions_mm = np.concatenate((np.reshape(start_mm, (1, -1)),
+                                   positions_mm))
+    axis_s = _axis_move_times_s(controller, channels, positions_mm)
+    critical = axis_s.argmax(axis=1)
+    move_s = axis_s[np.arange(len(axis_s)), critical]
+    critical_s = {ch: float(move_s[critical == i].sum())
+                  for i, ch in enumerate(channels)}
+    return {'total_s': float(move_s.sum() + overhead_s * len(move_s)),
+            'move_s': move_s,
+            'critical_channel': np.asarray(channels)[critical],
+            'critical_s': critical_s}
+
+def _predict_move_times_s(controller, channels, positions_mm):
+    # predicted duration of each move along the trajectory:
+    return _axis_move_times_s(
+        controller, channels, positions_mm).max(axis=1)
+
+def _axis_move_times_s(controller, channels, positions_mm):
+    # predicted duration of each move (rows) for each axis (columns), the
+    # vectorized 'Controller.estimate_move_time':
+    distance_mm = np.abs(np.diff(positions_mm, axis=0))
+    times_s = np.zeros_like(distance_mm)
+    for i, ch in enumerate(channels):
+        scale, offset_s = controller._motion_calibration[ch]
+        model_s = _move_times_s(distance_mm[:, i],
+                                controller._max_speed[ch],
+                                controller._max_acceleration[ch])
+        times_s[:, i] = np.where(
+            distance_mm[:, i] > 0, offset_s + scale * model_s, 0)
+    return times_s
+
+def _move_times_s(distance_mm, max_speed, max_acceleration):
+    # numpy version of 'thorlabs_MCM301._move_time_s':
+    distance_mm = np.asarray(distance_mm, dtype='float64')
+    trapezoid = distance_mm / max_speed + max_speed / max_acceleration
+    triangle = 2 * np.sqrt(distance_mm / max_acceleration)
+    times_s = np.where(
+        distance_mm >= max_speed**2 / max_acceleration, trapezoid, triangle)
+    return np.where(distance_mm > 0, times_s, 0)
+
+if __name__ == '__main__':
+    from thorlabs_MCM301 import Controller
+    from thorlabs_MCM301_sim import SimulatedMCM301
+    stages = ('MPM-000001', 'MPM-000002', None)
+    controller = Controller(sn='TP00000000-000000',
+                            stages=stages,
+                            min_mm=( 0,  0, None),
+                            max_mm=(10, 10, None),
+                            backend=SimulatedMCM301(
+                                stages=stages,
+                                stage_parameters={'max_speed': 50,
+                                                  'max_acceleration': 500},
+                                latency_s=1e-3),
+                            verbose=False)
+    scan = Scan(controller)
+
+    def acquire(index, position_mm): # e.g. 10ms exposure, 20ms readout
+        time.sleep(10e-3)
+        scan.release()
+        time.sleep(20e-3)
+
+    for order in ('raster', 'serpentine', 'fastest'):
+        channels, positions_mm = grid_scan(
+            controller, {0: (0, 2, 0.5), 1: (0, 2, 0.5)}, order=order)
+        plan = plan_scan(controller, channels, positions_mm)
+        print('%s: %0.3fs predicted move time'%(order, plan['total_s']))
+    for overlap in (False, True):
+        result = scan.run(positions_mm, acquire, overlap=overlap)
+        print('overlap=%s: %0.1f points/s '%(overlap, result['points_per_s']) +
+              '(settle %0.1fms, callback %0.1fms)'%(
+                  1e3 * result['settle_s'].mean(),
+                  1e3 * result['callback_s'].mean()))
+    for tolerance_counts in (None, 20):
+        scan = ZStack(controller, 1, tolerance_counts) # ('acquire' releases)
+        stack = scan.run(1, 1.1, 0.005, acquire, overlap=True)
+        print('z-stack, tolerance_counts=%s: %0.1f slices/s '%(
+            tolerance_counts, stack['slices_per_s']) +
+              '(settle %0.1fms, max error %0.0fnm)'%(
+                  stack['settle_ms'], 1e6 * abs(stack['error_mm']).max()))
+    controller.close()
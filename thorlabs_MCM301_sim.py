@@ -0,0 +1,362 @@
+# Imports from the python standard library:
+import threading
+import time
+
+# Our code, one .py file per module, copy files to your local directory:
+from thorlabs_MCM301 import Backend, StageParamStruct, check_error
+
+class SimulatedMCM301(Backend):
+    '''
+    In-process simulation of a thorlabs MCM301 that can replace the .dll
+    (e.g. Controller(..., backend=SimulatedMCM301())) so the adaptor runs
+    without hardware. The three slots (4, 5, 6) move with trapezoidal
+    profiles built from the 'StageParamStruct' values (max_speed in mm/s,
+    max_acceleration in mm/s^2) and every call holds the simulated serial
+    link for a configurable latency, so throughput and latency can be
+    measured reproducibly.
+    '''
+    def __init__(self,
+                 sn='TP00000000-000000',
+                 stages=('MPM-000001', 'MPM-000002', 'MPM-000003'),
+                 stage_parameters=None, # dict e.g. {'max_speed': 10}
+                 latency_s=0, # serial latency applied to every call
+                 call_latency_s=None, # per call e.g. {'get_status': 2e-3}
+                 initial_counts=3*(250000,), # encoder count at power on
+                 homed=False,
+                 enabled=False):
+        assert len(stages) == 3
+        assert len(initial_counts) == 3
+        self.sn = sn
+        self.latency_s = latency_s
+        self.call_latency_s = {}
+        if call_latency_s is not None:
+            self.call_latency_s.update(call_latency_s)
+        self.calls = {} # call counts by name
+        parameters = dict(counts_per_step=8,
+                          nm_per_count=5,
+                          min_count=0,
+                          max_count=5000000,
+                          max_speed=5,
+                          max_acceleration=20)
+        if stage_parameters is not None:
+            parameters.update(stage_parameters)
+        self._lock = threading.RLock() # one serial link per controller
+        self._t0 = time.perf_counter()
+        self._hdl = None
+        self._slots = {}
+        for slot, stage, count in zip((4, 5, 6), stages, initial_counts):
+            state = {'stage': stage}
+            if stage is not None:
+                state.update(
+                    parameters=StageParamStruct(**parameters),
+                    count=count,
+                    enabled=enabled,
+                    homed=homed,
+                    homing=False,
+                    home_to_min=True,
+                    velocity_pct=100,
+                    profile=None,
+                    jog_step=0,
+                    jogging=False,
+                    obstructed=False)
+            self._slots[slot] = state
+
+    def _now(self):
+        return time.perf_counter() - self._t0
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        latency_s = self.call_latency_s.get(name, self.latency_s)
+        if latency_s > 0:
+            time.sleep(latency_s)
+        return None
+
+    def _get_slot(self, hdl, slot):
+        if hdl != self._hdl or slot not in self._slots:
+            check_error(-1)
+        state = self._slots[slot]
+        if state['stage'] is None:
+            check_error(-1)
+        self._update(state)
+        return state
+
+    def _limits(self, state):
+        p = state['parameters']
+        if state['home_to_min']:
+            return p.min_count, p.max_count
+        return -p.max_count, -p.min_count # home to max -> negative range
+
+    def obstruct(self, slot, obstructed=True):
+        # fault injection: the stage stops moving but the motor still
+        # reports moving (e.g. a collision or a slipping coupling) until
+        # 'stop' or 'obstructed=False' (which resumes towards the target):
+        with self._lock:
+            state = self._slots[slot]
+            self._update(state)
+            state['obstructed'] = obstructed
+            if not obstructed and state['profile'] is not None:
+                self._start_profile(state, state['profile']['target'])
+            return None
+
+    def _update(self, state):
+        profile = state['profile']
+        if profile is None or state['obstructed']:
+            return None
+        t = self._now() - profile['t0']
+        if t >= profile['duration']:
+            state['count'] = profile['target']
+            state['profile'], state['jogging'] = None, False
+            if state['homing']:
+                state['homing'], state['homed'] = False, True
+            return None
+        distance = _trapezoid_distance(
+            t, profile['distance'], profile['speed'], profile['acceleration'])
+        state['count'] = int(round(
+            profile['start'] + profile['direction'] * distance))
+        return None
+
+    def _start_profile(self, state, target):
+        p = state['parameters']
+        counts_per_mm = 1e6 / p.nm_per_count
+        speed = counts_per_mm * p.max_speed * state['velocity_pct'] / 100
+        acceleration = counts_per_mm * p.max_acceleration
+        distance = abs(target - state['count'])
+        state['profile'] = {
+            't0': self._now(),
+            'start': state['count'],
+            'target': target,
+            'direction': 1 if target >= state['count'] else -1,
+            'distance': distance,
+            'speed': speed,
+            'acceleration': acceleration,
+            'duration': _trapezoid_duration(distance, speed, acceleration)}
+        return None
+
+    def list_devices(self, buffer, buffer_length):
+        with self._lock:
+            self._call('list_devices')
+            buffer.value = ('%s,COM3'%self.sn).encode('ascii')
+            return 1
+
+    def open(self, sn, nBaud, timeout):
+        with self._lock:
+            self._call('open')
+            if sn.decode('ascii') != self.sn:
+                return -1
+            self._hdl = 0
+            return self._hdl
+
+    def is_open(self, sn):
+        with self._lock:
+            self._call('is_open')
+            return int(sn.decode('ascii') == self.sn and
+                       self._hdl is not None)
+
+    def get_device_type(self, hdl, slot, device_type, device_type_length):
+        with self._lock:
+            self._call('get_device_type')
+            if hdl != self._hdl or slot not in self._slots:
+                return check_error(-1)
+            stage = self._slots[slot]['stage']
+            device_type.value = b'' if stage is None else stage.encode('ascii')
+            return 0
+
+    def get_stage_parameters(self, hdl, slot, stage_params_info):
+        with self._lock:
+            self._call('get_stage_parameters')
+            state = self._get_slot(hdl, slot)
+            for field, _ in StageParamStruct._fields_:
+                setattr(stage_params_info, field,
+                        getattr(state['parameters'], field))
+            return 0
+
+    def get_home_to_min(self, hdl, slot, home_direction):
+        with self._lock:
+            self._call('get_home_to_min')
+            state = self._get_slot(hdl, slot)
+            home_direction.value = b'\x01' if state['home_to_min'] else b''
+            return 0
+
+    def set_home_to_min(self, hdl, slot, home_direction):
+        with self._lock:
+            self._call('set_home_to_min')
+            state = self._get_slot(hdl, slot)
+            state['home_to_min'] = bool(home_direction)
+            return 0
+
+    def get_status(self, hdl, slot, current_encoder, status_bit):
+        with self._lock:
+            self._call('get_status')
+            state = self._get_slot(hdl, slot)
+            bits = 0x00000100 # motor connected
+            low, high = self._limits(state)
+            if state['count'] >= high: bits |= 0x00000001
+            if state['count'] <= low:  bits |= 0x00000002
+            profile = state['profile']
+            if profile is not None:
+                if state['homing']:
+                    bits |= 0x00000200
+                elif state['jogging']:
+                    bits |= 0x00000040 if profile['direction'] > 0 else 0x80
+                elif profile['direction'] > 0:
+                    bits |= 0x00000010
+                else:
+                    bits |= 0x00000020
+            if state['homed']:   bits |= 0x00000400
+            if state['enabled']: bits |= 0x80000000
+            current_encoder.value = state['count']
+            status_bit.value = bits
+            return 0
+
+    def get_enable(self, hdl, slot, enable_state):
+        with self._lock:
+            self._call('get_enable')
+            state = self._get_slot(hdl, slot)
+            enable_state.value = b'\x01' if state['enabled'] else b''
+            return 0
+
+    def set_enable(self, hdl, slot, enable_state):
+        with self._lock:
+            self._call('set_enable')
+            state = self._get_slot(hdl, slot)
+            state['enabled'] = bool(enable_state)
+            if not state['enabled']:
+                state['profile'], state['homing'] = None, False
+            return 0
+
+    def home(self, hdl, slot):
+        with self._lock:
+            self._call('home')
+            state = self._get_slot(hdl, slot)
+            if not state['enabled']:
+                return check_error(-1)
+            state['homing'], state['homed'] = True, False
+            self._start_profile(state, 0)
+            return 0
+
+    def stop(self, hdl, slot):
+        with self._lock:
+            self._call('stop')
+            state = self._get_slot(hdl, slot)
+            state['profile'], state['homing'] = None, False
+            state['jogging'] = False
+            return 0
+
+    def set_velocity(self, hdl, slot, direction, velocity):
+        with self._lock:
+            self._call('set_velocity')
+            state = self._get_slot(hdl, slot)
+            if not 0 < velocity <= 100:
+                return check_error(-1)
+            state['velocity_pct'] = velocity
+            return 0
+
+    def get_position(self, hdl, slot, encoder_count, nm):
+        with self._lock:
+            self._call('get_position')
+            state = self._get_slot(hdl, slot)
+            nm.value = encoder_count * state['parameters'].nm_per_count
+            return 0
+
+    def get_encoder_count(self, hdl, slot, nm, encoder_count):
+        with self._lock:
+            self._call('get_encoder_count')
+            state = self._get_slot(hdl, slot)
+            encoder_count.value = int(round(
+                nm / state['parameters'].nm_per_count))
+            return 0
+
+    def move(self, hdl, slot, encoder_count):
+        with self._lock:
+            self._call('move')
+            state = self._get_slot(hdl, slot)
+            if not state['enabled']:
+                return check_error(-1)
+            low, high = self._limits(state)
+            target = min(max(encoder_count, low), high)
+            state['homing'], state['jogging'] = False, False
+            self._start_profile(state, target)
+            return 0
+
+    def set_jog_params(self, hdl, slot, step_size):
+        with self._lock:
+            self._call('set_jog_params')
+            state = self._get_slot(hdl, slot)
+            state['jog_step'] = step_size
+            return 0
+
+    def get_jog_params(self, hdl, slot, jog_step_size):
+        with self._lock:
+            self._call('get_jog_params')
+            state = self._get_slot(hdl, slot)
+            jog_step_size.value = state['jog_step']
+            return 0
+
+    def save_jog_params(self, hdl, slot):
+        with self._lock:
+            self._call('save_jog_params')
+            self._get_slot(hdl, slot)
+            return 0
+
+    def move_jog(self, hdl, slot, direction):
+        # one step of 'jog_step' counts, direction 1 is positive (clockwise):
+        with self._lock:
+            self._call('move_jog')
+            state = self._get_slot(hdl, slot)
+            if not state['enabled']:
+                return check_error(-1)
+            low, high = self._limits(state)
+            step = state['jog_step'] if direction else -state['jog_step']
+            target = min(max(state['count'] + step, low), high)
+            state['homing'], state['jogging'] = False, True
+            self._start_profile(state, target)
+            return 0
+
+    def close(self, hdl):
+        with self._lock:
+            self._call('close')
+            if hdl != self._hdl:
+                return check_error(-1)
+            self._hdl = None
+            return 0
+
+def _trapezoid_duration(distance, speed, acceleration):
+    # time to travel 'distance' from rest to rest with a trapezoidal profile:
+    if distance <= 0:
+        return 0
+    if distance >= speed**2 / acceleration: # reaches max speed
+        return distance / speed + speed / acceleration
+    return 2 * (distance / acceleration)**0.5 # triangular profile
+
+def _trapezoid_distance(t, distance, speed, acceleration):
+    # distance travelled at time 't' along the same profile:
+    duration = _trapezoid_duration(distance, speed, acceleration)
+    if t >= duration:
+        return distance
+    t_ramp = min(speed / acceleration, duration / 2)
+    if t <= t_ramp:
+        return 0.5 * acceleration * t**2
+    if t <= duration - t_ramp:
+        return 0.5 * acceleration * t_ramp**2 + acceleration * t_ramp * (
+            t - t_ramp)
+    return distance - 0.5 * acceleration * (duration - t)**2
+
+if __name__ == '__main__':
+    from thorlabs_MCM301 import Controller
+    controller = Controller(sn='TP00000000-000000',
+                            stages=('MPM-000001', 'MPM-000002', None),
+                            min_mm=( 0,  0, None),
+                            max_mm=(10, 10, None),
+                            home_to_min=(False, True, True),
+                            backend=SimulatedMCM301(
+                                stages=('MPM-000001', 'MPM-000002', None),
+                                stage_parameters={'max_speed': 50,
+                                                  'max_acceleration': 500},
+                                latency_s=1e-3))
+
+    print('\nAbsolute and relative moves:')
+    for ch in controller.channels:
+        controller.move_mm(ch, -1 if ch == 0 else 1, relative=False)
+        controller.move_mm(ch, 0.5)
+
+    controller.close()